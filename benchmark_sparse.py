@@ -0,0 +1,100 @@
+import time
+import argparse
+import statistics
+
+import torch
+import torch.nn.functional as F
+from torch_geometric.nn import SAGEConv
+
+from torch_geometric.data import Data
+
+from csr import CSRGraph
+from saint import GraphSAINTRandomWalkSampler
+from features import FeatureStore
+
+parser = argparse.ArgumentParser(
+    description='GraphSAINT training step time with COO edge_index vs. SpMM over adj_t')
+parser.add_argument('--num_nodes', type=int, default=100000)
+parser.add_argument('--avg_degree', type=int, default=25)
+parser.add_argument('--batch_size', type=int, default=2000)
+parser.add_argument('--walk_length', type=int, default=3)
+parser.add_argument('--num_features', type=int, default=100)
+parser.add_argument('--hidden_channels', type=int, default=256)
+parser.add_argument('--num_layers', type=int, default=3)
+parser.add_argument('--steps', type=int, default=20)
+parser.add_argument('--warmup', type=int, default=3)
+parser.add_argument('--repeats', type=int, default=4,
+                    help='timed passes per mode, alternating which mode runs first')
+parser.add_argument('--device', type=str, default='cpu')
+args = parser.parse_args()
+print(args)
+
+
+class SAGE(torch.nn.Module):
+    def __init__(self, in_channels, hidden_channels, out_channels, num_layers):
+        super(SAGE, self).__init__()
+        self.convs = torch.nn.ModuleList()
+        self.convs.append(SAGEConv(in_channels, hidden_channels))
+        for _ in range(num_layers - 2):
+            self.convs.append(SAGEConv(hidden_channels, hidden_channels))
+        self.convs.append(SAGEConv(hidden_channels, out_channels))
+
+    def forward(self, x, edge_index):
+        for conv in self.convs[:-1]:
+            x = F.relu(conv(x, edge_index))
+        return torch.log_softmax(self.convs[-1](x, edge_index), dim=-1)
+
+
+def step_time(model, optimizer, loader, sparse):
+    # Mean wall time of sampling a batch and running a forward/backward/update
+    # step on it, after `warmup` steps.
+    for i, data in enumerate(loader):
+        if i == args.warmup:
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+            start = time.perf_counter()
+        data = data.to(device)
+        optimizer.zero_grad()
+        out = model(data.x, data.adj_t if sparse else data.edge_index)
+        loss = F.nll_loss(out, data.y)
+        loss.backward()
+        optimizer.step()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / args.steps
+
+
+torch.manual_seed(12345)
+device = torch.device(args.device)
+N = args.num_nodes
+edge_index = torch.randint(N, (2, N * args.avg_degree // 2))
+edge_index = torch.cat([edge_index, edge_index.flip(0)], dim=1)
+graph = CSRGraph.from_edge_index(edge_index, N)
+data = Data(y=torch.randint(47, (N, )), num_nodes=N)
+features = FeatureStore(torch.randn(N, args.num_features))
+
+
+def run(sparse):
+    # Every pass starts from the same weights, optimizer state and batches,
+    # so neither mode inherits a trained model from the other.
+    torch.manual_seed(12345)
+    model = SAGE(args.num_features, args.hidden_channels, 47,
+                 args.num_layers).to(device)
+    optimizer = torch.optim.Adam(model.parameters(), lr=0.001)
+    loader = GraphSAINTRandomWalkSampler(
+        graph, data, batch_size=args.batch_size, walk_length=args.walk_length,
+        num_steps=args.warmup + args.steps, features=features, adj_t=sparse)
+    return step_time(model, optimizer, loader, sparse)
+
+
+# The modes take turns going first, so that neither always runs on a warm
+# allocator and caches.
+times = {False: [], True: []}
+for i in range(args.repeats):
+    for sparse in ([False, True] if i % 2 == 0 else [True, False]):
+        times[sparse].append(run(sparse))
+    print(f'pass {i}: edge_index: {times[False][-1] * 1e3:.1f} ms/step, '
+          f'adj_t: {times[True][-1] * 1e3:.1f} ms/step')
+coo, spmm = [statistics.median(times[sparse]) for sparse in [False, True]]
+print(f'median edge_index: {coo * 1e3:.1f} ms/step, adj_t: '
+      f'{spmm * 1e3:.1f} ms/step, speedup: {coo / spmm:.2f}x')
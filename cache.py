@@ -0,0 +1,66 @@
+import os
+import os.path as osp
+import json
+import shutil
+import hashlib
+
+import numpy as np
+import torch
+
+
+def graph_key(edge_index, num_nodes, *args):
+    r"""Returns a short hex digest of the content of :obj:`edge_index`, the
+    number of nodes and any extra arguments (e.g. :obj:`num_parts`), to be
+    used as a cache key that changes whenever the graph does."""
+    h = hashlib.sha1()
+    h.update(repr((num_nodes, ) + args).encode())
+    edge_index = edge_index.cpu().contiguous()
+    for start in range(0, edge_index.size(1), 1 << 24):
+        h.update(edge_index[:, start:start + (1 << 24)].contiguous().numpy())
+    return h.hexdigest()[:16]
+
+
+def csr_key(rowptr, col, *args):
+    r"""Like :meth:`graph_key`, for a graph given by the :obj:`rowptr` and
+    :obj:`col` of its CSR form (e.g. a :class:`csr.CSRGraph`)."""
+    h = hashlib.sha1()
+    h.update(repr((rowptr.numel() - 1, ) + args).encode())
+    for item in [rowptr, col]:
+        item = item.cpu().contiguous()
+        for start in range(0, item.numel(), 1 << 24):
+            h.update(item[start:start + (1 << 24)].numpy())
+    return h.hexdigest()[:16]
+
+
+def save_arrays(path, meta=None, **arrays):
+    r"""Saves every tensor of :obj:`arrays` as a raw :obj:`.npy` file in the
+    directory :obj:`path`, next to an optional :obj:`meta.json`. The
+    directory only appears once all files are written, so a crashed run
+    never leaves a partial cache behind."""
+    tmp = f'{path}.tmp{os.getpid()}'
+    os.makedirs(tmp, exist_ok=True)
+    for name, item in arrays.items():
+        if item is not None:
+            np.save(osp.join(tmp, f'{name}.npy'), item.cpu().numpy())
+    if meta is not None:
+        with open(osp.join(tmp, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+    if osp.exists(path):
+        shutil.rmtree(tmp)
+    else:
+        os.replace(tmp, path)
+
+
+def load_arrays(path, *names):
+    r"""Memory-maps the arrays :obj:`names` saved by :meth:`save_arrays`.
+    Pages are shared with every other process mapping the same files and
+    are only copied if written to. Missing arrays are returned as
+    :obj:`None`."""
+    out = []
+    for name in names:
+        filename = osp.join(path, f'{name}.npy')
+        if osp.exists(filename):
+            out.append(torch.from_numpy(np.load(filename, mmap_mode='c')))
+        else:
+            out.append(None)
+    return out
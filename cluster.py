@@ -6,7 +6,10 @@ from typing import Optional
 
 import torch
 import torch.utils.data
-from torch_sparse import SparseTensor, cat
+from torch_sparse import SparseTensor
+
+from cache import graph_key, save_arrays, load_arrays
+from csr import transposed_adj
 
 
 class ClusterData(torch.utils.data.Dataset):
@@ -22,8 +25,10 @@ class ClusterData(torch.utils.data.Dataset):
             recursive bisection instead of multilevel k-way partitioning.
             (default: :obj:`False`)
         save_dir (string, optional): If set, will save the partitioned data to
-            the :obj:`save_dir` directory for faster re-use.
-            (default: :obj:`None`)
+            the :obj:`save_dir` directory for faster re-use. The cache is
+            keyed by a hash of :obj:`edge_index`, the number of nodes,
+            :obj:`num_parts` and :obj:`recursive`, and is memory-mapped on
+            load. (default: :obj:`None`)
         log (bool, optional): If set to :obj:`False`, will not log any
             progress. (default: :obj:`True`)
     """
@@ -34,11 +39,16 @@ class ClusterData(torch.utils.data.Dataset):
 
         self.num_parts = num_parts
 
+        N = data.num_nodes
         recursive_str = '_recursive' if recursive else ''
-        filename = f'partition_{num_parts}{recursive_str}.pt'
+        key = graph_key(data.edge_index, N, num_parts, recursive)
+        filename = f'partition_{num_parts}{recursive_str}_{key}'
         path = osp.join(save_dir or '', filename)
         if save_dir is not None and osp.exists(path):
-            adj, partptr, perm = torch.load(path)
+            rowptr, col, value, partptr, perm = load_arrays(
+                path, 'rowptr', 'col', 'value', 'partptr', 'perm')
+            adj = SparseTensor(rowptr=rowptr, col=col, value=value,
+                               sparse_sizes=(N, N), is_sorted=True)
         else:
             if log:  # pragma: no cover
                 print('Computing METIS partitioning...', file=sys.stderr)
@@ -51,7 +61,9 @@ class ClusterData(torch.utils.data.Dataset):
             adj, partptr, perm = adj.partition(num_parts, recursive)
 
             if save_dir is not None:
-                torch.save((adj, partptr, perm), path)
+                rowptr, col, value = adj.csr()
+                save_arrays(path, rowptr=rowptr, col=col, value=value,
+                            partptr=partptr, perm=perm)
 
             if log:  # pragma: no cover
                 print('Done!', file=sys.stderr)
@@ -126,15 +138,47 @@ class ClusterLoader(torch.utils.data.DataLoader):
         `examples/cluster_gcn_ppi.py <https://github.com/pyg-team/
         pytorch_geometric/blob/master/examples/cluster_gcn_ppi.py>`_.
 
+    Every mini-batch carries the original ids of its nodes as :obj:`n_id`,
+    and the ids of its partitions, in the order of :obj:`node_cluster`, as
+    :obj:`part`.
+
     Args:
         cluster_data (torch_geometric.loader.ClusterData): The already
             partioned data object.
+        features (features.FeatureStore, optional): If set, the node
+            features :obj:`x` of every mini-batch are gathered from it by
+            original node id. (default: :obj:`None`)
+        transform (callable, optional): A function/transform that takes in
+            a mini-batch and returns a transformed version, applied inside
+            the worker processes (e.g. :class:`utils.PairAug`).
+            (default: :obj:`None`)
+        attrs (list, optional): If set, only these attributes of the
+            partitioned data are gathered into the mini-batches.
+            (default: :obj:`None`)
+        adj_t (bool, optional): If set to :obj:`True`, mini-batches carry
+            their edges as a transposed :class:`torch_sparse.SparseTensor`
+            :obj:`adj_t` instead of :obj:`edge_index`, and edge attributes
+            follow its non-zeros. (default: :obj:`False`)
         **kwargs (optional): Additional arguments of
             :class:`torch.utils.data.DataLoader`, such as :obj:`batch_size`,
             :obj:`shuffle`, :obj:`drop_last` or :obj:`num_workers`.
     """
-    def __init__(self, cluster_data, **kwargs):
+    def __init__(self, cluster_data, features=None, transform=None, attrs=None,
+                 adj_t=False, **kwargs):
         self.cluster_data = cluster_data
+        self.features = features
+        self.transform = transform
+        self.attrs = attrs
+        self.adj_t = adj_t
+
+        # Partition `p` owns the rows `partptr[p]:partptr[p + 1]` of the
+        # permuted adjacency and therefore the contiguous CSR slab of edges
+        # `eptr[p]:eptr[p + 1]`.
+        partptr = cluster_data.partptr
+        self.rowptr, self.col, self.value = cluster_data.data.adj.csr()
+        self.eptr = self.rowptr[partptr]
+        self.node_part = torch.repeat_interleave(
+            torch.arange(partptr.numel() - 1), partptr[1:] - partptr[:-1])
 
         super().__init__(range(len(cluster_data)), collate_fn=self.__collate__,
                          **kwargs)
@@ -144,37 +188,62 @@ class ClusterLoader(torch.utils.data.DataLoader):
             batch = torch.tensor(batch)
 
         N = self.cluster_data.data.num_nodes
-        E = self.cluster_data.data.num_edges
-
-        start = self.cluster_data.partptr[batch].tolist()
-        end = self.cluster_data.partptr[batch + 1].tolist()
-
-        a = []
-        b = []
-        i = 0
-        for s, e in zip(start, end):
-
-            a.append(torch.arange(s, e))
-            c = e - s
-            b.append(torch.full([c], i))
-            i = i + 1
-        node_idx = torch.cat(a)
-        node_cluster = torch.cat(b)
-
-        data = copy.copy(self.cluster_data.data)
-        del data.num_nodes
-        adj, data.adj = self.cluster_data.data.adj, None
-        adj = cat([adj.narrow(0, s, e - s) for s, e in zip(start, end)], dim=0)
-        adj = adj.index_select(1, node_idx)
-        row, col, edge_idx = adj.coo()
-        data.edge_index = torch.stack([row, col], dim=0)
-
-        for key, item in data:
+        E = self.col.numel()
+        partptr = self.cluster_data.partptr
+
+        # Nodes of the selected partitions, and the cluster they come from.
+        start = partptr[batch]
+        size = partptr[batch + 1] - start
+        offset = size.cumsum(0) - size
+        node_cluster = torch.repeat_interleave(torch.arange(batch.numel()), size)
+        node_idx = (torch.arange(node_cluster.numel()) - offset[node_cluster]
+                    + start[node_cluster])
+
+        # Edges of the selected row slabs.
+        estart = self.eptr[batch]
+        esize = self.eptr[batch + 1] - estart
+        edge_cluster = torch.repeat_interleave(torch.arange(batch.numel()), esize)
+        edge_pos = (torch.arange(edge_cluster.numel())
+                    - (esize.cumsum(0) - esize)[edge_cluster] + estart[edge_cluster])
+        row = torch.repeat_interleave(
+            torch.arange(node_idx.numel()),
+            self.rowptr[node_idx + 1] - self.rowptr[node_idx])
+
+        # Relabel columns through the partition they fall in and drop the
+        # links to partitions outside of the batch.
+        col = self.col[edge_pos]
+        part = self.node_part[col]
+        local = torch.full((partptr.numel() - 1, ), -1, dtype=torch.long)
+        local[batch] = offset
+        local = local[part]
+        mask = local >= 0
+        row = row[mask]
+        col = (local + col - partptr[part])[mask]
+        edge_pos = edge_pos[mask]
+
+        data = self.cluster_data.data.__class__()
+        edge_index = torch.stack([row, col], dim=0)
+        if self.adj_t:
+            data.adj_t, perm = transposed_adj(edge_index, node_idx.numel())
+            edge_pos = edge_pos[perm]
+        else:
+            data.edge_index = edge_index
+        edge_idx = None if self.value is None else self.value[edge_pos]
+
+        for key, item in self.cluster_data.data:
+            if key in ['adj', 'num_nodes']:
+                continue
+            if self.attrs is not None and key not in self.attrs:
+                continue
             if isinstance(item, torch.Tensor) and item.size(0) == N:
                 data[key] = item[node_idx]
             elif isinstance(item, torch.Tensor) and item.size(0) == E:
-                data[key] = item[edge_idx]
+                data[key] = item[edge_pos if edge_idx is None else edge_idx]
             else:
                 data[key] = item
         data['node_cluster'] = node_cluster
-        return data
+        data['part'] = batch
+        data['n_id'] = self.cluster_data.perm[node_idx]
+        if self.features is not None:
+            data['x'] = self.features[data['n_id']]
+        return data if self.transform is None else self.transform(data)
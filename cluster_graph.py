@@ -4,21 +4,25 @@
 import argparse
 
 import torch
-from tqdm import tqdm
 import torch.nn.functional as F
 
-from torch_geometric.loader import NeighborSampler
 from torch_geometric.nn import SAGEConv
 from torch_scatter import scatter_max, scatter
 from torch_geometric.utils import add_remaining_self_loops
 from cluster import ClusterData, ClusterLoader
 
-from ogb.nodeproppred import PygNodePropPredDataset, Evaluator
+from ogb.nodeproppred import PygNodePropPredDataset
 import math
-from copy import deepcopy
 import numpy as np
 
-from utils import permute_edges, drop_clusters, set_seeds, cluster_graph_aug
+from utils import permute_edges, drop_clusters, set_seeds, cluster_graph_aug, AutoR, PairAug
+from utils import mask_edges, union_graphs
+from loss import segment_jsd_loss
+from store import GraphStore
+from csr import CSRGraph
+from inference import InferenceEngine, AccuracySink, AsyncEvaluator, ProgressBar
+from features import FeatureStore, CachedFeatureStore
+from memory import MomentumEncoder, SummaryBank
 
 parser = argparse.ArgumentParser(description='OGBN-Products (Cluster-GCN)')
 parser.add_argument('--seed', type=int, default=777, help='Random seed.')
@@ -44,7 +48,51 @@ parser.add_argument('--rate', type=float, default=0.2, help='数据增强扰动
 parser.add_argument('--lam', type=float, default=0.01, help='约束损失系数')
 parser.add_argument('--limt', type=float, default=0.004, help='约束损失率')
 
+parser.add_argument('--aug_workers', action='store_true',
+                    help='build augmented views inside the loader workers')
+parser.add_argument('--prefetch', type=int, default=2,
+                    help='batches prefetched per loader worker')
+parser.add_argument('--fused', action='store_true',
+                    help='run the clean and augmented views as one disjoint-union graph per layer')
+parser.add_argument('--sparse', action='store_true',
+                    help='batches carry a transposed SparseTensor adj_t and layers propagate by SpMM')
+parser.add_argument('--memory', action='store_true',
+                    help='contrast the augmented view with clean summaries of a momentum encoder, '
+                         'kept in a memory bank, instead of training on the clean view')
+parser.add_argument('--momentum', type=float, default=0.99,
+                    help='EMA decay of the momentum encoder')
+parser.add_argument('--bank_momentum', type=float, default=0.,
+                    help='weight of a stored summary when it is recomputed (0 overwrites it)')
+parser.add_argument('--staleness', type=int, default=0,
+                    help='steps a stored summary is reused before it is recomputed')
+
+parser.add_argument('--store', type=str, default=None,
+                    help='directory of the compiled graph store (built on first use)')
+parser.add_argument('--features', type=str, default='fp32',
+                    choices=['fp32', 'fp16', 'int8'],
+                    help='storage type of the node features (fp16/int8 are memory-mapped)')
+parser.add_argument('--cache_size', type=int, default=0,
+                    help='feature rows of the highest-degree nodes kept in memory (0 disables)')
+parser.add_argument('--cache_policy', type=str, default='static',
+                    choices=['static', 'lru'], help='replacement policy of the feature cache')
+parser.add_argument('--eval_batch_size', type=int, default=1024,
+                    help='target nodes per batch of layer-wise inference')
+parser.add_argument('--eval_buffer', type=str, default=None,
+                    help='directory of the memory-mapped inference buffers (system temp if unset)')
+parser.add_argument('--eval_backend', type=str, default='sampler',
+                    choices=['sampler', 'spmm'],
+                    help='layer-wise inference on sampled batches, or as CPU CSR SpMM over row blocks')
+parser.add_argument('--eval_threads', type=int, default=1,
+                    help='row blocks the spmm backend processes concurrently')
+parser.add_argument('--eval_splits', type=str, default='train,valid,test',
+                    help='splits evaluated every test_freq epochs; without test, test is '
+                         'evaluated only when valid improves')
+parser.add_argument('--async_eval', action='store_true',
+                    help='evaluate weight snapshots in a background thread while training goes on')
+
 args = parser.parse_args()
+eval_splits = args.eval_splits.split(',')
+assert 'valid' in eval_splits
 
 seed = args.seed
 set_seeds(seed)
@@ -53,18 +101,36 @@ print(args)
 device = f'cuda:{args.device}' if torch.cuda.is_available() else 'cpu'
 device = torch.device(device)
 
-dataset = PygNodePropPredDataset(name='ogbn-products')
-split_idx = dataset.get_idx_split()
-data = dataset[0]
-if args.load_CL == 0:
-    print('yeah')
-    data.edge_index,_ = add_remaining_self_loops(data.edge_index)
+if args.store is not None:
+    # Self-looped CSR, features, labels and split masks, memory-mapped.
+    dataset = GraphStore.open(args.store, 'ogbn-products',
+                              self_loops=args.load_CL == 0)
+    split_idx = dataset.split_idx()
+    data = dataset.to_data()
+    graph = dataset.csr()
+else:
+    dataset = PygNodePropPredDataset(name='ogbn-products')
+    split_idx = dataset.get_idx_split()
+    data = dataset[0]
+    if args.load_CL == 0:
+        print('yeah')
+        data.edge_index,_ = add_remaining_self_loops(data.edge_index)
+    # Convert split indices to boolean masks and add them to `data`.
+    for key, idx in split_idx.items():
+        mask = torch.zeros(data.num_nodes, dtype=torch.bool)
+        mask[idx] = True
+        data[f'{key}_mask'] = mask
+    graph = CSRGraph.from_edge_index(data.edge_index, data.num_nodes)
+# Mini-batches gather their node features from the feature store.
+features = FeatureStore.open(dataset.processed_dir, data.x, args.features)
+# Evaluation reads the uncached store, so that full-graph passes neither
+# evict the hot rows nor count into the hit rate of training.
+eval_features = features
+if args.cache_size > 0:
+    features = CachedFeatureStore(features, args.cache_size, graph.degree(),
+                                  args.cache_policy)
+data.num_nodes, data.x = features.num_nodes, None
 sampler_data = data
-# Convert split indices to boolean masks and add them to `data`.
-for key, idx in split_idx.items():
-    mask = torch.zeros(data.num_nodes, dtype=torch.bool)
-    mask[idx] = True
-    data[f'{key}_mask'] = mask
 
 
 class SAGE(torch.nn.Module):
@@ -86,7 +152,10 @@ class SAGE(torch.nn.Module):
         for conv in self.convs:
             conv.reset_parameters()
 
-    def forward(self, x, edge_index, cluster):
+    def forward(self, x, edge_index, cluster, edge_mask=None):
+        if edge_mask is not None:
+            edge_index = mask_edges(edge_index, edge_mask)
+
         for conv in self.convs[:-1]:
             out = conv(x, edge_index)
             x = F.relu(out)
@@ -97,72 +166,79 @@ class SAGE(torch.nn.Module):
 
         return torch.log_softmax(x, dim=-1), out, g
 
-    def inference(self, x_all, subgraph_loader, device):
-        pbar = tqdm(total=x_all.size(0) * len(self.convs))
-        pbar.set_description('Evaluating')
-
-        for i, conv in enumerate(self.convs):
-            xs = []
-            for batch_size, n_id, adj in subgraph_loader:
-                edge_index, _, size = adj.to(device)
-                x = x_all[n_id].to(device)
-                x_target = x[:size[1]]
-                x = conv((x, x_target), edge_index)
-                if i != len(self.convs) - 1:
-                    x = F.relu(x)
-                xs.append(x.cpu())
-
-                pbar.update(batch_size)
-
-            x_all = torch.cat(xs, dim=0)
+    def forward_pair(self, x, edge_index, cluster, edge_mask):
+        # The augmented and the clean view as one graph of 2N nodes and 2C
+        # clusters, the augmented one first, so that every layer runs one
+        # SAGEConv over both; the outputs are split back per view.
+        N, C = x.size(0), int(cluster.max()) + 1
+        x = torch.cat([x, x], dim=0)
+        edge_index = union_graphs(mask_edges(edge_index, edge_mask),
+                                  edge_index, N)
+        pre, out, g = self(x, edge_index, torch.cat([cluster, cluster + C]))
+        return tuple(zip(pre.split(N), out.split(N), g.split(C)))
+
+    def inference(self, x_all, engine, device, targets=None, sink=None):
+        # Layer by layer over *all* edges (or the receptive field of
+        # `targets`); the engine streams every layer into a memory-mapped
+        # buffer, or fed to `sink` for the last layer.
+        return engine.run(self.convs, x_all, device, targets, sink)
 
-        pbar.close()
+    def jsd_loss(self, enc1, enc2, indices):
+        # Each node's only positive is the summary of its own cluster.
+        return segment_jsd_loss(enc1, enc2, indices)
 
-        return x_all
 
-    def jsd_loss(self, enc1, enc2, indices):
-        pos_mask = torch.eye(enc1.shape[0], enc2.shape[0], device=enc1.device)
-        if enc1.shape[0] != enc2.shape[0]:
-            pos_mask = pos_mask[indices]
-        neg_mask = 1. - pos_mask
-        logits = enc1 @ enc2.t()
-        Epos = (np.log(2.) - F.softplus(- logits))
-        Eneg = (F.softplus(-logits) + logits - np.log(2.))
-        Epos = (Epos * pos_mask).sum() / pos_mask.sum()
-        Eneg = (Eneg * neg_mask).sum() / neg_mask.sum()
-        return Eneg - Epos
-
-
-def train(model, loader, optimizer, device, epoch, args):
+def train(model, loader, optimizer, device, epoch, args, autor, memory=None):
     model.train()
+    if args.cache_size > 0:
+        features.reset_stats()
     total_loss = 0
     total_examples = 0
     total_correct = 0
     i = 0
 
-    rate = args.rate
-    aug = []
-
     if epoch > args.load_CL:
         print("CL")
         print("epoch:", epoch)
         for data in loader:
             i = i + 1
             # print("rate1", rate)
-            data_aug = deepcopy(data)
-            cluster = data.node_cluster
-            view1 = cluster_graph_aug(data_aug, rate, cluster)
-            view1 = view1.to(device)
-            data = data.to(device)
+            if args.aug_workers:
+                data, view1 = data
+                view1 = view1.to(device)
+                data = view1.data
+                cluster = data.node_cluster
+            else:
+                data = data.to(device)
+                cluster = data.node_cluster
+                view1 = cluster_graph_aug(data, autor.rate, cluster)
             optimizer.zero_grad()
-            cluster = cluster.to(device)
-
-            aug_pre, x1, g1 = model(view1.x, view1.edge_index, cluster)
-            y_pre, x2, g2 = model(data.x, data.edge_index, cluster)
 
-            loss1 = model.jsd_loss(x1, g2, cluster)
-            loss2 = model.jsd_loss(x2, g1, cluster)
-            loss_cl = (loss1 + loss2) / 10
+            # The augmented view masks the edges of the batch.
+            edge_index = data.adj_t if args.sparse else data.edge_index
+            if memory is not None:
+                # Only the augmented view is trained; the clean summaries of
+                # the partitions come from the bank, recomputed without
+                # gradients by the momentum encoder once they are stale.
+                target, bank = memory
+                aug_pre, x1, g1 = model(view1.x, edge_index, cluster,
+                                        edge_mask=view1.edge_mask)
+                g2 = bank.fetch(data.part, lambda: target(
+                    data.x, edge_index, cluster)[2], device)
+
+                loss_cl = model.jsd_loss(x1, g2, cluster) / 5
+            else:
+                if args.fused:
+                    (aug_pre, x1, g1), (y_pre, x2, g2) = model.forward_pair(
+                        data.x, edge_index, cluster, view1.edge_mask)
+                else:
+                    aug_pre, x1, g1 = model(view1.x, edge_index, cluster,
+                                            edge_mask=view1.edge_mask)
+                    y_pre, x2, g2 = model(data.x, edge_index, cluster)
+
+                loss1 = model.jsd_loss(x1, g2, cluster)
+                loss2 = model.jsd_loss(x2, g1, cluster)
+                loss_cl = (loss1 + loss2) / 10
 
             # out = y_pre[data.train_mask]
             out = aug_pre[data.train_mask]
@@ -174,18 +250,14 @@ def train(model, loader, optimizer, device, epoch, args):
 
             loss.backward()
             optimizer.step()
+            if memory is not None:
+                target.update(model)
+                bank.step()
 
             # aug_pre = aug_pre[data.train_mask]
             # aug_y = y
             aug_loss = loss
-            aug.append(aug_loss)
-            # print("aug_loss:", aug_loss)
-
-            if i >= 2:
-                if aug[i - 1] < aug[i - 2]:
-                    rate = rate + args.limt * torch.sigmoid(aug[i - 2] - aug[i - 1])
-                elif aug[i - 1] > aug[i - 2]:
-                    rate = rate - args.limt * torch.sigmoid(aug[i - 1] - aug[i - 2])
+            autor.step(aug_loss)
 
 
 
@@ -196,7 +268,9 @@ def train(model, loader, optimizer, device, epoch, args):
             # if i % 100 == 0:
             #     print(f'Batch:{i},loss_train:{loss_train:.6f}, loss_cl:{loss_cl:.6f}, loss:{loss:.6f}')
             total_loss += float(loss_train)
-        rate_epoch = rate
+        rate_epoch = autor.end_epoch()
+        if args.cache_size > 0:
+            print(features)
 
         print('rate_epoch:', rate_epoch)
         loss = total_loss / len(loader)
@@ -211,6 +285,8 @@ def train(model, loader, optimizer, device, epoch, args):
         print("original")
         for data in loader:
             i = i + 1
+            if args.aug_workers:
+                data = data[0]
             ###
             data = permute_edges(data, args.rate)
             ###
@@ -218,7 +294,8 @@ def train(model, loader, optimizer, device, epoch, args):
 
             optimizer.zero_grad()
             cluster = data.node_cluster
-            y_pre, _, _ = model(data.x, data.edge_index, cluster)
+            edge_index = data.adj_t if args.sparse else data.edge_index
+            y_pre, _, _ = model(data.x, edge_index, cluster)
             out = y_pre[data.train_mask]
             y = data.y.squeeze(1)[data.train_mask]
 
@@ -235,62 +312,106 @@ def train(model, loader, optimizer, device, epoch, args):
 
 
 @torch.no_grad()
-def test(model, data, evaluator, subgraph_loader, device):
+def test(model, data, features, engine, device,
+         splits=('train', 'valid', 'test')):
     model.eval()
 
-    out = model.inference(data.x, subgraph_loader, device)
-
-    y_true = data.y
-    y_pred = out.argmax(dim=-1, keepdim=True)
+    # Only the receptive field of the requested splits is computed, and the
+    # predictions are counted per split as they come out of the last layer;
+    # the other splits are reported as nan.
+    masks = {key: data[f'{key}_mask'] for key in splits}
+    targets = None
+    if len(splits) < 3:
+        targets = torch.stack(list(masks.values())).any(dim=0)
+    sink = model.inference(features, engine, device, targets,
+                           AccuracySink(data.y, masks))
 
-    train_acc = evaluator.eval({
-        'y_true': y_true[data.train_mask],
-        'y_pred': y_pred[data.train_mask]
-    })['acc']
-    valid_acc = evaluator.eval({
-        'y_true': y_true[data.valid_mask],
-        'y_pred': y_pred[data.valid_mask]
-    })['acc']
-    test_acc = evaluator.eval({
-        'y_true': y_true[data.test_mask],
-        'y_pred': y_pred[data.test_mask]
-    })['acc']
-
-    return train_acc, valid_acc, test_acc
+    return tuple(sink.accuracy(key) if key in splits else float('nan')
+                 for key in ['train', 'valid', 'test'])
 
 
 def main():
     cluster_data = ClusterData(data, num_parts=args.num_partitions,
                                recursive=False, save_dir=dataset.processed_dir)
 
-    loader = ClusterLoader(cluster_data, batch_size=args.batch_size,
-                           shuffle=True, num_workers=args.num_workers)
+    # AutoR publishes the rate here so that loader workers can read it.
+    shared_rate = torch.full((1, ), args.rate, dtype=torch.double).share_memory_()
+    loader_kwargs = {}
+    if args.aug_workers:
+        loader_kwargs['transform'] = PairAug(cluster_graph_aug, shared_rate)
+        if args.num_workers > 0:
+            loader_kwargs['prefetch_factor'] = args.prefetch
+
+    loader = ClusterLoader(cluster_data, features=features,
+                           attrs=['y', 'train_mask'], adj_t=args.sparse,
+                           batch_size=args.batch_size, shuffle=True,
+                           num_workers=args.num_workers, **loader_kwargs)
+
+    # The partitions keep their own adjacency; evaluation samples from the
+    # int32 CSR, so the int64 `edge_index` is no longer needed, neither in
+    # `data` nor in the dataset it shares its tensors with.
+    data.edge_index = None
+    if args.store is None:
+        dataset._data.edge_index = None
+    # Under --async_eval the engine runs in a background thread while the
+    # main thread trains, where forking loader workers can deadlock and a
+    # progress bar would garble the training log.
+    engine = InferenceEngine(graph, batch_size=args.eval_batch_size,
+                             num_workers=0 if args.async_eval else args.num_workers,
+                             buffer_dir=args.eval_buffer,
+                             progress=None if args.async_eval else ProgressBar(),
+                             backend=args.eval_backend,
+                             num_threads=args.eval_threads)
+
+    model = SAGE(features.num_features, args.hidden_channels, dataset.num_classes,
+                 args.num_layers, args.dropout).to(device)
+
+    def report(epoch, tra, val, tst):
+        print(f'Epoch:{epoch}, train:{tra:.6f}, val:{val:.6f}, test:{tst:.6f}')
 
-    subgraph_loader = NeighborSampler(data.edge_index, sizes=[-1],
-                                      batch_size=1024, shuffle=False,
-                                      num_workers=args.num_workers)
+    if args.async_eval:
+        async_eval = AsyncEvaluator(
+            model, lambda model, splits: test(model, data, eval_features,
+                                              engine, device, splits),
+            eval_splits, report)
 
-    model = SAGE(data.x.size(-1), args.hidden_channels, dataset.num_classes,
-                 args.num_layers, args.dropout).to(device)
+    memory = None
+    if args.memory:
+        memory = (MomentumEncoder(model, args.momentum),
+                  SummaryBank(args.num_partitions, args.hidden_channels,
+                              args.bank_momentum, args.staleness))
 
-    evaluator = Evaluator(name='ogbn-products')
     vals, tests = [], []
     for run in range(args.runs):
         best_val, final_test = 0, 0
 
         model.reset_parameters()
+        if memory is not None:
+            memory[0].reset(model)
+            memory[1].reset()
         optimizer = torch.optim.Adam(model.parameters(), lr=args.lr)
         args.rate = 0.2
+        autor = AutoR(args.rate, args.limt, mode='sigmoid', shared=shared_rate)
         for epoch in range(1, args.epochs + 1):
-            loss, acc, rate_epoch = train(model, loader, optimizer, device, epoch, args)
+            loss, acc, rate_epoch = train(model, loader, optimizer, device, epoch,
+                                          args, autor, memory)
             args.rate = rate_epoch
+            if args.async_eval:
+                async_eval.poll()
             if epoch > 100 and epoch % args.test_freq == 0 or epoch == args.epochs:
+                if args.async_eval:
+                    async_eval.submit(epoch, model)
+                    continue
 
-                result = test(model, data, evaluator, subgraph_loader, device)
+                result = test(model, data, eval_features, engine, device,
+                              eval_splits)
                 tra, val, tst = result
-                print(f'Epoch:{epoch}, train:{tra:.6f}, val:{val:.6f}, test:{tst:.6f}')
+                report(epoch, tra, val, tst)
                 if val > best_val:
                     best_val = val
+                    if 'test' not in eval_splits:
+                        tst = test(model, data, eval_features, engine,
+                                   device, ['test'])[2]
                     final_test = tst
 
             # elif epoch > 9 and epoch % 10 == 0 or epoch == args.epochs:
@@ -302,6 +423,9 @@ def main():
             #         best_val = val
             #         final_test = tst
 
+        if args.async_eval:
+            best_val, final_test = async_eval.join()
+            async_eval.reset()
         print(f'Run{run} val:{best_val:.6f}, test:{final_test:.6f}')
         vals.append(best_val)
         tests.append(final_test)
@@ -0,0 +1,222 @@
+import torch
+import torch.utils.data
+from torch_sparse import SparseTensor
+from torch_geometric.loader.neighbor_sampler import EdgeIndex
+
+
+def transposed_adj(edge_index, num_nodes):
+    r"""Returns the transposed adjacency :obj:`adj_t` of :obj:`edge_index` as
+    a row-sorted :class:`torch_sparse.SparseTensor`, for message passing by
+    SpMM, and the permutation that brings the edges of :obj:`edge_index` into
+    the order of its non-zeros (to carry edge attributes along)."""
+    row, col = edge_index[1], edge_index[0]
+    perm = (row * num_nodes + col).argsort()
+    adj_t = SparseTensor(row=row[perm], col=col[perm],
+                         sparse_sizes=(num_nodes, num_nodes), is_sorted=True)
+    return adj_t, perm
+
+
+class CSRGraph(object):
+    r"""Read-only, target-major compressed sparse row adjacency shared by
+    every sampler and inference pass of a trainer: row :obj:`i` lists the
+    sources of the edges pointing to :obj:`i`, as in the :obj:`adj_t` of
+    :class:`torch_geometric.loader.NeighborSampler`.
+
+    :obj:`rowptr` is kept as :obj:`int64` and :obj:`col` as :obj:`int32`, so
+    the graph takes :obj:`4 * E + 8 * N` bytes instead of the :obj:`16 * E`
+    of an :obj:`edge_index` (and the :obj:`24 * E` or more of a
+    :class:`torch_sparse.SparseTensor` with edge ids).
+
+    Args:
+        rowptr (torch.Tensor): The row pointers, of size :obj:`N + 1`.
+        col (torch.Tensor): The source node of every edge, of size :obj:`E`.
+    """
+    def __init__(self, rowptr, col):
+        assert rowptr.dim() == 1 and col.dim() == 1
+        self.rowptr = rowptr.to(torch.long)
+        self.col = col if col.dtype == torch.int32 else col.to(torch.int32)
+        self.num_nodes = rowptr.numel() - 1
+        self.num_edges = col.numel()
+
+    @classmethod
+    def from_edge_index(cls, edge_index, num_nodes=None):
+        r"""Builds the graph of :obj:`edge_index`, whose second row holds the
+        targets."""
+        if num_nodes is None:
+            num_nodes = int(edge_index.max()) + 1
+        row, col = edge_index[1], edge_index[0]
+        perm = torch.sort(row, stable=True)[1]
+        rowptr = torch.zeros(num_nodes + 1, dtype=torch.long)
+        rowptr[1:] = torch.bincount(row, minlength=num_nodes).cumsum(0)
+        return cls(rowptr, col[perm].to(torch.int32))
+
+    def share_memory_(self):
+        self.rowptr.share_memory_()
+        self.col.share_memory_()
+        return self
+
+    def degree(self, index=None):
+        if index is None:
+            return self.rowptr[1:] - self.rowptr[:-1]
+        return self.rowptr[index + 1] - self.rowptr[index]
+
+    def edge_index(self):
+        # Materializes the (source, target) COO form, for the PyG samplers
+        # that only take an `edge_index`.
+        row = torch.repeat_interleave(torch.arange(self.num_nodes),
+                                      self.degree())
+        return torch.stack([self.col.to(torch.long), row], dim=0)
+
+    def sample(self, index, size):
+        r"""Samples up to :obj:`size` incoming edges of every node in
+        :obj:`index` without replacement (all of them if :obj:`size < 0`).
+        Returns the local target of every sampled edge and its position in
+        :obj:`col`, which serves as the edge id."""
+        start = self.rowptr[index]
+        deg = self.rowptr[index + 1] - start
+
+        if size < 0:
+            full = torch.ones_like(deg, dtype=torch.bool)
+        else:
+            full = deg <= size
+        # Nodes with few enough neighbors keep all of them.
+        row = torch.repeat_interleave(full.nonzero().view(-1), deg[full])
+        ptr = deg[full].cumsum(0) - deg[full]
+        offset = (torch.arange(row.numel())
+                  - torch.repeat_interleave(ptr, deg[full]))
+        rows, offsets = [row], [offset]
+
+        part = (~full).nonzero().view(-1)
+        if part.numel() > 0:
+            # Floyd's algorithm, run for all remaining nodes at once: step
+            # `j` draws `t` from `[0, deg - size + j]` and takes `t`, or the
+            # new maximum `deg - size + j` if `t` was already drawn. Every
+            # `size`-subset is equally likely, for O(size^2) work per node
+            # whatever its degree.
+            d = deg[part]
+            chosen = torch.empty((part.numel(), size), dtype=torch.long)
+            for j in range(size):
+                hi = d - size + j
+                t = (torch.rand(part.numel()) * (hi + 1)).long()
+                t = torch.minimum(t, hi)
+                seen = (chosen[:, :j] == t.view(-1, 1)).any(dim=1)
+                chosen[:, j] = torch.where(seen, hi, t)
+            rows.append(part.repeat_interleave(size))
+            offsets.append(chosen.view(-1))
+
+        row, offset = torch.cat(rows), torch.cat(offsets)
+        return row, start[row] + offset
+
+    def __repr__(self):
+        return (f'{self.__class__.__name__}(num_nodes={self.num_nodes}, '
+                f'num_edges={self.num_edges})')
+
+
+class CSRNeighborSampler(torch.utils.data.DataLoader):
+    r"""Drop-in replacement of :class:`torch_geometric.loader.NeighborSampler`
+    that samples from a shared :class:`CSRGraph` instead of building its own
+    :class:`torch_sparse.SparseTensor` copy of the graph.
+
+    Yields :obj:`(batch_size, n_id, adjs)` exactly like
+    :class:`~torch_geometric.loader.NeighborSampler`: the targets come first
+    in :obj:`n_id`, and :obj:`adjs` holds one
+    :obj:`EdgeIndex(edge_index, e_id, size)` per layer, outermost hop first
+    (or a single one if :obj:`len(sizes) == 1`). :obj:`e_id` refers to the
+    edge positions in :obj:`graph.col`.
+
+    If :obj:`drop_rate` is given, every mini-batch additionally carries an
+    edge-dropped view :obj:`adja` of :obj:`adjs`, drawn in the same pass as
+    in :meth:`utils.ns_graph_aug`: hop :obj:`i` (outermost first) loses
+    :obj:`int(E_i * rate / (i + 1))` of its edges, clamped to
+    :obj:`[0, E_i]`. The augmented hops keep a
+    sorted subset of the edges of the clean ones, and share :obj:`n_id`, the
+    edge ids and the sizes with them.
+
+    Args:
+        graph (CSRGraph): The graph to sample from.
+        sizes ([int]): The number of neighbors to sample for each node in
+            each layer. If set to :obj:`sizes[l] = -1`, all neighbors are
+            included in layer :obj:`l`.
+        node_idx (torch.Tensor, optional): The nodes that should be
+            considered for creating mini-batches. If set to :obj:`None`, all
+            nodes will be considered. (default: :obj:`None`)
+        transform (callable, optional): A function/transform that takes in
+            a sampled mini-batch and returns a transformed version.
+            (default: :obj:`None`)
+        drop_rate (torch.Tensor, optional): One-element tensor in shared
+            memory holding the current edge drop rate, kept up to date by
+            :class:`utils.AutoR`. If set, mini-batches are yielded as
+            :obj:`(batch_size, n_id, adjs, adja)`. (default: :obj:`None`)
+        **kwargs (optional): Additional arguments of
+            :class:`torch.utils.data.DataLoader`, such as :obj:`batch_size`,
+            :obj:`shuffle`, :obj:`drop_last` or :obj:`num_workers`.
+    """
+    def __init__(self, graph, sizes, node_idx=None, transform=None,
+                 drop_rate=None, **kwargs):
+        self.graph = graph
+        self.sizes = sizes
+        self.transform = transform
+        self.drop_rate = drop_rate
+
+        if node_idx is None:
+            node_idx = torch.arange(graph.num_nodes)
+        elif node_idx.dtype == torch.bool:
+            node_idx = node_idx.nonzero(as_tuple=False).view(-1)
+        self.node_idx = node_idx
+
+        # Global-to-local relabeling table, reset after every mini-batch.
+        self.assoc = None
+
+        super().__init__(node_idx.view(-1).tolist(), collate_fn=self.sample,
+                         **kwargs)
+
+    def sample(self, batch):
+        if not isinstance(batch, torch.Tensor):
+            batch = torch.tensor(batch)
+
+        if self.assoc is None:  # Allocated lazily, once per worker.
+            self.assoc = torch.full((self.graph.num_nodes, ), -1,
+                                    dtype=torch.long)
+        assoc = self.assoc
+
+        batch_size = batch.numel()
+        n_id = batch
+        assoc[n_id] = torch.arange(batch_size)
+
+        adjs = []
+        for size in self.sizes:
+            row, e_id = self.graph.sample(n_id, size)
+            col = self.graph.col[e_id].to(torch.long)
+
+            new = col[assoc[col] < 0].unique()
+            assoc[new] = torch.arange(n_id.numel(), n_id.numel() + new.numel())
+            size = (n_id.numel() + new.numel(), n_id.numel())
+            n_id = torch.cat([n_id, new])
+
+            edge_index = torch.stack([assoc[col], row], dim=0)
+            adjs.append(EdgeIndex(edge_index, e_id, size))
+
+        assoc[n_id] = -1
+
+        adjs = adjs[::-1]
+        out = (batch_size, n_id, adjs[0] if len(adjs) == 1 else adjs)
+        if self.drop_rate is not None:
+            adja = self.drop_edges(adjs, float(self.drop_rate))
+            out = out + (adja[0] if len(adja) == 1 else adja, )
+        out = self.transform(*out) if self.transform is not None else out
+        return out
+
+    @staticmethod
+    def drop_edges(adjs, rate):
+        out = []
+        for i, adj in enumerate(adjs):
+            num = adj.edge_index.size(1)
+            # AutoR does not bound the rate.
+            drop = min(max(int(num * rate * 1 / (i + 1)), 0), num)
+            keep = torch.randperm(num)[drop:].sort()[0]
+            out.append(EdgeIndex(adj.edge_index[:, keep], adj.e_id[keep],
+                                 adj.size))
+        return out
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(sizes={self.sizes})'
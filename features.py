@@ -0,0 +1,228 @@
+import os
+import os.path as osp
+import shutil
+import threading
+import multiprocessing as mp
+
+import numpy as np
+import torch
+
+from cache import load_arrays
+
+DTYPES = ['fp32', 'fp16', 'int8']
+
+
+def compile_features(path, x, dtype='fp16', chunk_size=1 << 16):
+    r"""Writes the node features :obj:`x` to :obj:`path` as :obj:`fp16`, or
+    as :obj:`int8` with one symmetric scale per column, streaming over row
+    chunks so that :obj:`x` may itself be a memory-mapped matrix larger
+    than RAM."""
+    assert dtype in ['fp16', 'int8']
+    N, F = x.size()
+
+    scale = None
+    if dtype == 'int8':
+        absmax = torch.zeros(F)
+        for start in range(0, N, chunk_size):
+            chunk = x[start:start + chunk_size].float().abs().max(dim=0)[0]
+            absmax = torch.maximum(absmax, chunk)
+        scale = (absmax / 127).clamp(min=1e-12)
+
+    tmp = f'{path}.tmp{os.getpid()}'
+    os.makedirs(tmp, exist_ok=True)
+    out = np.lib.format.open_memmap(
+        osp.join(tmp, 'x.npy'), mode='w+', shape=(N, F),
+        dtype=np.float16 if dtype == 'fp16' else np.int8)
+    for start in range(0, N, chunk_size):
+        chunk = x[start:start + chunk_size].float()
+        if scale is None:
+            chunk = chunk.half()
+        else:
+            chunk = (chunk / scale).round().clamp(-127, 127).to(torch.int8)
+        out[start:start + chunk.size(0)] = chunk.numpy()
+    out.flush()
+    del out
+    if scale is not None:
+        np.save(osp.join(tmp, 'scale.npy'), scale.numpy())
+
+    if osp.exists(path):
+        shutil.rmtree(tmp)
+    else:
+        os.replace(tmp, path)
+
+
+class FeatureStore(object):
+    r"""Node feature matrix, optionally stored as :obj:`fp16` or as per-column
+    quantized :obj:`int8`, that hands out :obj:`float32` rows through
+    :meth:`gather`. Rows are dequantized after they were gathered (and moved
+    to :obj:`device`), so only the compact rows are read and transferred.
+
+    Args:
+        x (torch.Tensor): The stored features, possibly memory-mapped.
+        scale (torch.Tensor, optional): The per-column scale of :obj:`int8`
+            features. (default: :obj:`None`)
+    """
+    def __init__(self, x, scale=None):
+        self.x = x
+        self.scale = scale
+        self._scales = {}
+
+    @classmethod
+    def open(cls, root, x, dtype='fp32'):
+        r"""Returns the features :obj:`x` in :obj:`dtype`. :obj:`fp32` uses
+        :obj:`x` as is; the other types are compiled once into :obj:`root`
+        and memory-mapped from there."""
+        assert dtype in DTYPES
+        if dtype == 'fp32':
+            return cls(x)
+        path = osp.join(root, f'features_{dtype}')
+        if not osp.exists(path):
+            compile_features(path, x, dtype)
+        return cls(*load_arrays(path, 'x', 'scale'))
+
+    @property
+    def num_nodes(self):
+        return self.x.size(0)
+
+    @property
+    def num_features(self):
+        return self.x.size(1)
+
+    def size(self, dim=None):
+        return self.x.size() if dim is None else self.x.size(dim)
+
+    def to(self, device):
+        return FeatureStore(self.x.to(device), self.scale)
+
+    def rows(self, index):
+        # The stored (possibly quantized) rows of `index`.
+        return self.x[index]
+
+    def gather(self, index, device=None):
+        x = self.rows(index)
+        if device is not None:
+            x = x.to(device)
+        if self.scale is not None:
+            if x.device not in self._scales:
+                self._scales[x.device] = self.scale.to(x.device)
+            return x.float() * self._scales[x.device]
+        return x.float()
+
+    def __getitem__(self, index):
+        return self.gather(index)
+
+    def __repr__(self):
+        return (f'{self.__class__.__name__}({self.num_nodes}, '
+                f'{self.num_features}, dtype={self.x.dtype})')
+
+
+class CachedFeatureStore(FeatureStore):
+    r"""Bounded in-memory cache of the (still quantized) rows of a
+    :class:`FeatureStore`, seeded with the :obj:`capacity` nodes of highest
+    degree, which sampled mini-batches visit far more often than the rest.
+    Rows that miss the cache are read from the backing store.
+
+    With :obj:`policy="lru"`, missed rows replace the least recently used
+    ones after every :meth:`gather`. Loader workers each evolve their own
+    copy of an LRU cache, but all of them count into the same shared
+    :obj:`hits`/:obj:`misses` counters.
+
+    The cache serves training batches only: full-graph evaluation should
+    read the backing store, or it evicts the hot rows and counts into the
+    hit rate of the training epoch.
+
+    Args:
+        store (FeatureStore): The backing feature store.
+        capacity (int): The number of rows kept in memory.
+        degree (torch.Tensor): The degree of every node, e.g.
+            :meth:`csr.CSRGraph.degree` of the self-looped graph.
+        policy (str, optional): :obj:`"static"` or :obj:`"lru"`.
+            (default: :obj:`"static"`)
+    """
+    def __init__(self, store, capacity, degree, policy='static'):
+        assert policy in ['static', 'lru']
+        super().__init__(store.x, store.scale)
+        self.policy = policy
+        self.capacity = capacity = min(capacity, store.num_nodes)
+
+        hot = degree.topk(capacity).indices
+        self.slot = torch.full((store.num_nodes, ), -1, dtype=torch.long)
+        self.slot[hot] = torch.arange(capacity)
+        self.owner = hot
+        self.cache = store.x[hot]
+        self.stamp = torch.zeros(capacity, dtype=torch.long)
+        self.tick = 0
+
+        self.stats = torch.zeros(2, dtype=torch.long).share_memory_()
+        # Loader workers are processes that add to the same counters.
+        self.stats_lock = mp.Lock()
+        # The LRU state is updated on every gather, which may come from
+        # several threads of the process.
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    @property
+    def hits(self):
+        return int(self.stats[0])
+
+    @property
+    def misses(self):
+        return int(self.stats[1])
+
+    @property
+    def hit_rate(self):
+        return self.hits / max(self.hits + self.misses, 1)
+
+    def reset_stats(self):
+        self.stats.zero_()
+
+    def rows(self, index):
+        if self.policy == 'lru':
+            with self.lock:
+                return self.lookup(index)
+        return self.lookup(index)
+
+    def lookup(self, index):
+        index = torch.as_tensor(index).view(-1)
+        slot = self.slot[index]
+        hit = slot >= 0
+        miss = (~hit).nonzero(as_tuple=False).view(-1)
+
+        x = torch.empty((index.numel(), self.num_features), dtype=self.x.dtype)
+        x[hit] = self.cache[slot[hit]]
+        x[miss] = self.x[index[miss]]
+
+        with self.stats_lock:
+            self.stats[0] += index.numel() - miss.numel()
+            self.stats[1] += miss.numel()
+
+        if self.policy == 'lru':
+            self.tick += 1
+            self.stamp[slot[hit]] = self.tick
+            self.admit(index[miss], x[miss])
+        return x
+
+    def admit(self, index, x):
+        # Moves the rows `x` of the distinct nodes `index` into the slots
+        # that were used least recently.
+        k = min(index.numel(), self.capacity)
+        index, x = index[:k], x[:k]
+        victim = self.stamp.topk(k, largest=False).indices
+        self.slot[self.owner[victim]] = -1
+        self.slot[index] = victim
+        self.owner[victim] = index
+        self.cache[victim] = x
+        self.stamp[victim] = self.tick
+
+    def __repr__(self):
+        return (f'{self.__class__.__name__}(capacity={self.capacity}, '
+                f'policy={self.policy}, hits={self.hits}, '
+                f'misses={self.misses}, hit_rate={self.hit_rate:.4f})')
@@ -0,0 +1,410 @@
+import copy
+import hashlib
+import tempfile
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch_sparse import SparseTensor, matmul
+from tqdm import tqdm
+
+from csr import CSRNeighborSampler
+from features import FeatureStore
+
+
+def memmap_buffer(num_rows, num_cols, buffer_dir=None):
+    r"""Returns a zero-initialized :obj:`float32` matrix backed by an
+    anonymous temporary file in :obj:`buffer_dir`, so it may be larger than
+    RAM. The file goes away together with the last reference to it."""
+    with tempfile.TemporaryFile(dir=buffer_dir) as f:
+        buf = np.memmap(f, dtype=np.float32, mode='w+',
+                        shape=(num_rows, num_cols))
+    return torch.from_numpy(buf)
+
+
+class AccuracySink(object):
+    r"""Folds the last-layer outputs of :class:`InferenceEngine` into running
+    per-split correct/total counters, batch by batch, so that the final
+    logits are never stored. :meth:`accuracy` matches the :obj:`acc` of
+    :class:`ogb.nodeproppred.Evaluator` for single-label node
+    classification.
+
+    Args:
+        y (torch.Tensor): The label of every node.
+        masks (dict): The boolean node mask of every split.
+        num_classes (int, optional): If set, a :obj:`num_classes x
+            num_classes` confusion matrix (true class by predicted class) is
+            accumulated per split as well. (default: :obj:`None`)
+    """
+    def __init__(self, y, masks, num_classes=None):
+        self.y = y.view(-1)
+        self.masks = masks
+        self.num_classes = num_classes
+        self.correct = {key: 0 for key in masks}
+        self.total = {key: 0 for key in masks}
+        self.confusion = None
+        if num_classes is not None:
+            self.confusion = {
+                key: torch.zeros(num_classes, num_classes, dtype=torch.long)
+                for key in masks
+            }
+        # Blocks of the `spmm` backend report from several threads.
+        self.lock = threading.Lock()
+
+    def __call__(self, index, out):
+        pred = out.argmax(dim=-1).cpu()
+        y = self.y[index]
+        with self.lock:
+            for key, mask in self.masks.items():
+                mask = mask[index]
+                self.correct[key] += int((pred[mask] == y[mask]).sum())
+                self.total[key] += int(mask.sum())
+                if self.confusion is not None:
+                    C = self.num_classes
+                    self.confusion[key] += torch.bincount(
+                        y[mask] * C + pred[mask], minlength=C * C).view(C, C)
+
+    def accuracy(self, key):
+        return self.correct[key] / max(self.total[key], 1)
+
+
+class ProgressBar(object):
+    r"""A :obj:`progress` callback of :class:`InferenceEngine` that shows a
+    tqdm bar over the nodes of every layer of a pass.
+
+    Args:
+        desc (str, optional): The prefix of the bars.
+            (default: :obj:`"Evaluating"`)
+    """
+    def __init__(self, desc='Evaluating'):
+        self.desc = desc
+        self.bar = None
+
+    def __call__(self, layer, done, total):
+        if self.bar is None:
+            self.bar = tqdm(total=total, desc=f'{self.desc} layer {layer}')
+        self.bar.update(done - self.bar.n)
+        if done >= total:
+            self.bar.close()
+            self.bar = None
+
+
+class InferenceEngine(object):
+    r"""Layer-wise full-neighbor inference that never holds a whole layer in
+    RAM: layer :obj:`i` reads its inputs from the memory-mapped outputs of
+    layer :obj:`i - 1` and streams its own outputs, batch by batch, into a
+    preallocated memory-mapped buffer, instead of collecting them in a list
+    and concatenating them.
+
+    Args:
+        graph (csr.CSRGraph): The graph to propagate over.
+        batch_size (int, optional): The number of target nodes per batch.
+            (default: :obj:`4096`)
+        num_workers (int, optional): The number of sampling workers.
+            (default: :obj:`0`)
+        buffer_dir (string, optional): The directory of the layer buffers.
+            If set to :obj:`None`, the system temporary directory is used.
+            (default: :obj:`None`)
+        progress (callable, optional): Called after every batch as
+            :obj:`progress(layer, num_done, num_total)`.
+            (default: :obj:`None`)
+        backend (str, optional): :obj:`"sampler"` to run the layers on
+            full-neighbor :class:`csr.CSRNeighborSampler` batches on any
+            device, or :obj:`"spmm"` to run them on the CPU as a sparse-dense
+            matrix product per block of CSR rows (see :meth:`run_spmm`).
+            (default: :obj:`"sampler"`)
+        num_threads (int, optional): The number of row blocks the
+            :obj:`"spmm"` backend processes concurrently, each of them with
+            the intra-op threads of torch. (default: :obj:`1`)
+    """
+    def __init__(self, graph, batch_size=4096, num_workers=0, buffer_dir=None,
+                 progress=None, backend='sampler', num_threads=1):
+        assert backend in ['sampler', 'spmm']
+        self.graph = graph
+        self.batch_size = batch_size
+        self.backend = backend
+        self.num_threads = num_threads
+        self.num_workers = num_workers
+        self.buffer_dir = buffer_dir
+        self.progress = progress
+        self.loader = self.loader_of(None)
+        # Blocks of the `spmm` backend, by set of targets (see `plan`).
+        self.plans = {}
+
+    def loader_of(self, node_idx):
+        return CSRNeighborSampler(self.graph, sizes=[-1], node_idx=node_idx,
+                                  batch_size=self.batch_size, shuffle=False,
+                                  num_workers=self.num_workers)
+
+    def receptive_fields(self, targets, num_layers):
+        r"""Returns, for every layer, the nodes whose outputs are needed to
+        compute the last layer at :obj:`targets`: the targets themselves for
+        the last layer, and the previous set together with its in-neighbors
+        for every layer before it."""
+        N = self.graph.num_nodes
+        if targets.dtype == torch.bool:
+            targets = targets.nonzero(as_tuple=False).view(-1)
+
+        fields = [targets]
+        for _ in range(num_layers - 1):
+            mask = torch.zeros(N, dtype=torch.bool)
+            mask[fields[0]] = True
+            for start in range(0, fields[0].numel(), 1 << 16):
+                _, e_id = self.graph.sample(fields[0][start:start + (1 << 16)],
+                                            -1)
+                mask[self.graph.col[e_id].to(torch.long)] = True
+            fields.insert(0, mask.nonzero(as_tuple=False).view(-1))
+        return fields
+
+    @torch.no_grad()
+    def run(self, convs, x_all, device, targets=None, sink=None):
+        r"""Applies the bipartite layers :obj:`convs` (with ReLU in between)
+        to the node features :obj:`x_all`, a :class:`features.FeatureStore`
+        or a tensor, and returns the memory-mapped outputs of the last
+        layer.
+
+        If :obj:`targets` (node indices or a boolean mask) is set, every
+        layer only runs on the receptive field of the targets (see
+        :meth:`receptive_fields`), and only the rows of :obj:`targets` of
+        the result are valid.
+
+        If :obj:`sink` is set, every batch of last-layer outputs is passed
+        to :obj:`sink(index, out)` (e.g. an :class:`AccuracySink`) instead
+        of being stored, and :obj:`sink` is returned."""
+        if self.backend == 'spmm':
+            return self.run_spmm(convs, x_all, targets, sink)
+
+        N = self.graph.num_nodes
+
+        if targets is None:
+            loaders = [self.loader] * len(convs)
+            totals = [N] * len(convs)
+        else:
+            fields = self.receptive_fields(targets, len(convs))
+            loaders = [self.loader_of(field) for field in fields]
+            totals = [field.numel() for field in fields]
+
+        for i, conv in enumerate(convs):
+            out = None
+            done = 0
+            for batch_size, n_id, adj in loaders[i]:
+                edge_index, _, size = adj.to(device)
+                if isinstance(x_all, FeatureStore):
+                    x = x_all.gather(n_id, device)
+                else:
+                    x = x_all[n_id].to(device)
+                x_target = x[:size[1]]
+                x = conv((x, x_target), edge_index)
+                if i != len(convs) - 1:
+                    x = F.relu(x)
+                elif sink is not None:
+                    sink(n_id[:batch_size], x)
+                    x = None
+
+                if x is not None:
+                    if out is None:
+                        out = memmap_buffer(N, x.size(-1), self.buffer_dir)
+                    out[n_id[:batch_size]] = x.cpu()
+
+                done += batch_size
+                if self.progress is not None:
+                    self.progress(i, done, totals[i])
+
+            # Drops the last reference to the previous layer's buffer.
+            x_all = out
+
+        return x_all if sink is None else sink
+
+    def dense_features(self, x_all):
+        # The float32 feature matrix on the host, dequantized into a buffer if
+        # needed; the store may have been moved to the training device.
+        if not isinstance(x_all, FeatureStore):
+            return x_all.cpu()
+        if x_all.scale is None and x_all.x.dtype == torch.float:
+            return x_all.x.cpu()
+        N = x_all.num_nodes
+        out = memmap_buffer(N, x_all.num_features, self.buffer_dir)
+        for start in range(0, N, 1 << 16):
+            index = torch.arange(start, min(start + (1 << 16), N))
+            out[index] = x_all.gather(index, 'cpu')
+        return out
+
+    def block_adj(self, index):
+        # The CSR rows of the nodes `index`, as a SparseTensor over all nodes
+        # whose values are `1 / deg`, i.e. the row-normalized adjacency.
+        start = self.graph.rowptr[index]
+        deg = self.graph.rowptr[index + 1] - start
+        rowptr = torch.zeros(index.numel() + 1, dtype=torch.long)
+        rowptr[1:] = deg.cumsum(0)
+        e_id = (torch.repeat_interleave(start - rowptr[:-1], deg)
+                + torch.arange(int(rowptr[-1])))
+        value = torch.repeat_interleave(1. / deg.clamp(min=1), deg)
+        return SparseTensor(rowptr=rowptr, col=self.graph.col[e_id].long(),
+                            value=value,
+                            sparse_sizes=(index.numel(), self.graph.num_nodes),
+                            is_sorted=True)
+
+    def plan(self, targets, num_layers):
+        r"""Returns, for every layer of :meth:`run_spmm`, the blocks of
+        :obj:`batch_size` rows it runs on as :obj:`(index, adj)` pairs, with
+        the row-normalized adjacency :obj:`adj` of the rows :obj:`index`.
+
+        The blocks are built once per engine and set of :obj:`targets`, and
+        shared by all layers of a full pass, so they hold a copy of the
+        (receptive field of the) graph with :obj:`int64` columns."""
+        if targets is None:
+            key = None
+        else:
+            if targets.dtype == torch.bool:
+                targets = targets.nonzero(as_tuple=False).view(-1)
+            digest = hashlib.sha1(targets.cpu().numpy().tobytes())
+            key = (num_layers, digest.hexdigest())
+
+        if key not in self.plans:
+            if targets is None:
+                fields = [torch.arange(self.graph.num_nodes)]
+            else:
+                fields = self.receptive_fields(targets, num_layers)
+            self.plans[key] = [[(index, self.block_adj(index))
+                                for index in field.split(self.batch_size)]
+                               for field in fields]
+
+        plan = self.plans[key]
+        return plan * num_layers if targets is None else plan
+
+    @torch.no_grad()
+    def run_spmm(self, convs, x_all, targets=None, sink=None):
+        r"""CPU backend of :meth:`run` for :class:`SAGEConv` layers with mean
+        aggregation. Every block of :obj:`batch_size` rows is aggregated as
+        a product with its precomputed row-normalized adjacency (see
+        :meth:`plan`), followed by the two linear projections :obj:`lin_l`
+        and :obj:`lin_r`, and written into the output buffer. Nothing is
+        sampled, relabeled or gathered per batch, and :obj:`num_threads`
+        blocks run concurrently."""
+        N = self.graph.num_nodes
+        x_all = self.dense_features(x_all)
+        plan = self.plan(targets, len(convs))
+
+        with ThreadPoolExecutor(self.num_threads) as pool:
+            for i, conv in enumerate(convs):
+                lin_l, lin_r = conv.lin_l, getattr(conv, 'lin_r', None)
+                weight_l = lin_l.weight.detach().cpu()
+                bias_l = None if lin_l.bias is None else lin_l.bias.detach().cpu()
+                weight_r = None if lin_r is None else lin_r.weight.detach().cpu()
+                last = i == len(convs) - 1
+                out = None
+                if not last or sink is None:
+                    out = memmap_buffer(N, weight_l.size(0), self.buffer_dir)
+
+                # Only called within this iteration, so the closure always
+                # sees this layer's inputs, weights and buffer.
+                def propagate(block):
+                    index, adj = block
+                    h = matmul(adj, x_all, reduce='sum')
+                    h = F.linear(h, weight_l, bias_l)
+                    if weight_r is not None:
+                        h += F.linear(x_all[index], weight_r)
+                    if not last:
+                        out[index] = F.relu(h)
+                    elif sink is not None:
+                        sink(index, h)
+                    else:
+                        out[index] = h
+                    return index.numel()
+
+                done = 0
+                total = sum(index.numel() for index, _ in plan[i])
+                for size in pool.map(propagate, plan[i]):
+                    done += size
+                    if self.progress is not None:
+                        self.progress(i, done, total)
+
+                x_all = out
+
+        return x_all if sink is None else sink
+
+    def __repr__(self):
+        return (f'{self.__class__.__name__}(backend={self.backend}, '
+                f'batch_size={self.batch_size}, '
+                f'buffer_dir={self.buffer_dir})')
+
+
+class AsyncEvaluator(object):
+    r"""Runs :obj:`test` on snapshots of the model weights in a background
+    thread, so that training goes on while an epoch is evaluated.
+
+    Snapshots are evaluated one at a time, in the order they were
+    submitted, on a private copy of the model. Best validation and final
+    test accuracy are tracked the same way as in the synchronous loop:
+    :obj:`final_test` is the test accuracy of the epoch with the best
+    validation accuracy so far, evaluated separately if :obj:`splits` does
+    not include :obj:`"test"`.
+
+    :obj:`test` must not fork processes (e.g. :class:`InferenceEngine` with
+    :obj:`num_workers > 0`): forking a process from a background thread
+    while the main thread trains can deadlock the child.
+
+    Args:
+        model (torch.nn.Module): The model to evaluate.
+        test (callable): Called as :obj:`test(model, splits)` in the
+            background thread; returns the :obj:`(train, valid, test)`
+            accuracies, with :obj:`nan` for the splits not evaluated.
+        splits ([str], optional): The splits evaluated at every epoch.
+            (default: :obj:`('train', 'valid', 'test')`)
+        report (callable, optional): Called as
+            :obj:`report(epoch, train, valid, test)` in the calling thread,
+            in epoch order, as results come in. (default: :obj:`None`)
+        max_pending (int, optional): The number of snapshots that may wait
+            for evaluation before :meth:`submit` blocks. (default: :obj:`2`)
+    """
+    def __init__(self, model, test, splits=('train', 'valid', 'test'),
+                 report=None, max_pending=2):
+        self.model = copy.deepcopy(model)
+        self.test = test
+        self.splits = splits
+        self.report = report
+        self.max_pending = max_pending
+        self.pool = ThreadPoolExecutor(1)
+        self.pending = deque()
+        self.reset()
+
+    def reset(self):
+        self.best_val, self.final_test = 0, 0
+
+    def submit(self, epoch, model):
+        # The snapshot is taken right away, so `model` may keep training.
+        state = {key: item.detach().clone()
+                 for key, item in model.state_dict().items()}
+        while len(self.pending) >= self.max_pending:
+            self.merge(*self.pending.popleft())
+        self.pending.append((epoch, self.pool.submit(self.evaluate, state)))
+
+    def evaluate(self, state):
+        self.model.load_state_dict(state)
+        train_acc, val_acc, test_acc = self.test(self.model, self.splits)
+        if val_acc > self.best_val:
+            self.best_val = val_acc
+            if 'test' not in self.splits:
+                test_acc = self.test(self.model, ['test'])[2]
+            self.final_test = test_acc
+        return train_acc, val_acc, test_acc
+
+    def merge(self, epoch, future):
+        result = future.result()
+        if self.report is not None:
+            self.report(epoch, *result)
+
+    def poll(self):
+        r"""Reports the results that are ready, in epoch order."""
+        while self.pending and self.pending[0][1].done():
+            self.merge(*self.pending.popleft())
+
+    def join(self):
+        r"""Waits for all submitted snapshots and returns
+        :obj:`(best_val, final_test)`."""
+        while self.pending:
+            self.merge(*self.pending.popleft())
+        return self.best_val, self.final_test
@@ -0,0 +1,79 @@
+import math
+
+import torch
+import torch.nn.functional as F
+
+
+class TiledJSD(torch.autograd.Function):
+    r"""Jensen-Shannon contrastive loss between the rows of :obj:`enc1` and
+    :obj:`enc2`, where the pair :obj:`(i, j)` is positive if
+    :obj:`label1[i] == label2[j]` and negative otherwise.
+
+    The :obj:`enc1 @ enc2.t()` logits are produced :obj:`chunk_size` rows at
+    a time in both the forward and the backward pass, so neither the full
+    logits nor the positive/negative masks are ever materialized.
+    """
+    @staticmethod
+    def forward(ctx, enc1, enc2, label1, label2, chunk_size):
+        log2 = math.log(2.)
+        pos_sum = enc1.new_zeros(())
+        neg_sum = enc1.new_zeros(())
+        num_pos = enc1.new_zeros(())
+        for start in range(0, enc1.size(0), chunk_size):
+            logits = enc1[start:start + chunk_size] @ enc2.t()
+            mask = label1[start:start + chunk_size].view(-1, 1) == label2.view(1, -1)
+            sp = F.softplus(-logits)
+            pos_sum += torch.where(mask, log2 - sp, sp.new_zeros(())).sum()
+            neg_sum += torch.where(mask, sp.new_zeros(()), sp + logits - log2).sum()
+            num_pos += mask.sum()
+        num_neg = enc1.size(0) * enc2.size(0) - num_pos
+
+        ctx.save_for_backward(enc1, enc2, label1, label2, num_pos, num_neg)
+        ctx.chunk_size = chunk_size
+        return neg_sum / num_neg - pos_sum / num_pos
+
+    @staticmethod
+    def backward(ctx, grad_out):
+        enc1, enc2, label1, label2, num_pos, num_neg = ctx.saved_tensors
+        chunk_size = ctx.chunk_size
+        grad1 = torch.empty_like(enc1)
+        grad2 = torch.zeros_like(enc2)
+        for start in range(0, enc1.size(0), chunk_size):
+            x = enc1[start:start + chunk_size]
+            logits = x @ enc2.t()
+            mask = label1[start:start + chunk_size].view(-1, 1) == label2.view(1, -1)
+            # d/dl [log2 - softplus(-l)] = sigmoid(-l),
+            # d/dl [softplus(-l) + l - log2] = sigmoid(l).
+            grad = torch.where(mask, -torch.sigmoid(-logits) / num_pos,
+                               torch.sigmoid(logits) / num_neg) * grad_out
+            grad1[start:start + chunk_size] = grad @ enc2
+            grad2 += grad.t() @ x
+        return grad1, grad2, None, None, None
+
+
+def jsd_loss(enc1, enc2, label1, label2=None, chunk_size=512):
+    r"""Tiled, mask-free version of :obj:`SAGE.jsd_loss`; positives are the
+    pairs that share a label (or a cluster id) in :obj:`label1` and
+    :obj:`label2` (defaults to :obj:`label1`)."""
+    if label2 is None:
+        label2 = label1
+    return TiledJSD.apply(enc1, enc2, label1.view(-1), label2.view(-1),
+                          chunk_size)
+
+
+def segment_jsd_loss(x, g, cluster):
+    r"""Node-vs-subgraph Jensen-Shannon loss, where node :obj:`i` is positive
+    only for its own summary :obj:`g[cluster[i]]`.
+
+    The positive term is a gather of :obj:`logits[i, cluster[i]]` and the
+    negative term is the row sum minus that gather, so only the
+    :obj:`N x G` logits are allocated.
+    """
+    log2 = math.log(2.)
+    num_neg = x.size(0) * g.size(0) - x.size(0)
+    logits = x @ g.t()
+    pos = logits.gather(1, cluster.view(-1, 1)).view(-1)
+    # softplus(-l) + l == softplus(l)
+    Epos = (log2 - F.softplus(-pos)).mean()
+    Eneg = (F.softplus(logits).sum() - F.softplus(pos).sum()) / num_neg - log2
+    return Eneg - Epos
@@ -0,0 +1,126 @@
+import copy
+
+import torch
+
+
+class MomentumEncoder(object):
+    r"""Exponential moving average copy of a model that provides the
+    target-side subgraph summaries of the contrastive loss without tracking
+    gradients, so that the clean view needs no backward pass (and, while the
+    :class:`SummaryBank` holds fresh summaries, no forward pass either).
+
+    The copy runs in evaluation mode, i.e. without dropout.
+
+    Args:
+        model (torch.nn.Module): The online model.
+        momentum (float, optional): The decay of the weight average; :obj:`0`
+            follows the online weights exactly. (default: :obj:`0.99`)
+    """
+    def __init__(self, model, momentum=0.99):
+        self.momentum = momentum
+        self.model = copy.deepcopy(model).eval()
+        for param in self.model.parameters():
+            param.requires_grad_(False)
+
+    def reset(self, model):
+        for param, online in zip(self.model.parameters(), model.parameters()):
+            param.copy_(online.detach())
+
+    @torch.no_grad()
+    def update(self, model):
+        for param, online in zip(self.model.parameters(), model.parameters()):
+            param.mul_(self.momentum).add_(online.detach(),
+                                           alpha=1 - self.momentum)
+
+    @torch.no_grad()
+    def __call__(self, *args, **kwargs):
+        return self.model(*args, **kwargs)
+
+
+class SummaryBank(object):
+    r"""Memory bank of subgraph summaries indexed by a global id (a node id,
+    or a partition id for Cluster-GCN), kept on the host. A write replaces
+    the stored summaries, or blends the new ones into them with an
+    exponential moving average if :obj:`momentum > 0`. Entries that were
+    never written or are older than :obj:`staleness` steps are stale, and
+    :meth:`fetch` recomputes them.
+
+    Rows are only allocated for the ids that are actually written (e.g. the
+    anchors or training nodes out of all nodes of the graph), next to an
+    :obj:`int64` id-to-row table of :obj:`num_entries`.
+
+    Args:
+        num_entries (int): The number of ids.
+        num_features (int): The size of a summary.
+        momentum (float, optional): The weight of the stored summary in a
+            write. As an id is only written when it comes up again, this
+            average spans far more training than the one of
+            :class:`MomentumEncoder`. (default: :obj:`0`)
+        staleness (int, optional): The number of steps a summary may be
+            reused before it has to be recomputed; :obj:`0` recomputes the
+            summaries of every step. (default: :obj:`0`)
+    """
+    def __init__(self, num_entries, num_features, momentum=0., staleness=0):
+        self.momentum = momentum
+        self.staleness = staleness
+        self.slot = torch.full((num_entries, ), -1, dtype=torch.long)
+        self.value = torch.empty(0, num_features)
+        self.stamp = torch.empty(0, dtype=torch.long)
+        self.size = 0
+        self.clock = 0
+
+    def reset(self):
+        # Keeps the allocated rows for the next run.
+        self.slot.fill_(-1)
+        self.size = 0
+        self.clock = 0
+
+    def step(self):
+        self.clock += 1
+
+    def stale(self, index):
+        slot = self.slot[index.cpu()]
+        stale = slot < 0
+        seen = ~stale
+        stale[seen] = self.clock - self.stamp[slot[seen]] > self.staleness
+        return stale
+
+    def allocate(self, index):
+        # Assigns the next rows to the new ids `index`, growing the storage
+        # geometrically.
+        end = self.size + index.numel()
+        if end > self.value.size(0):
+            capacity = max(end, 2 * self.value.size(0))
+            value = self.value.new_zeros(capacity, self.value.size(1))
+            value[:self.size] = self.value[:self.size]
+            stamp = self.stamp.new_zeros(capacity)
+            stamp[:self.size] = self.stamp[:self.size]
+            self.value, self.stamp = value, stamp
+        self.slot[index] = torch.arange(self.size, end)
+        self.size = end
+
+    def write(self, index, value):
+        # `index` holds distinct ids.
+        index, value = index.cpu(), value.detach().cpu().float()
+        seen = self.slot[index] >= 0
+        self.allocate(index[~seen])
+        slot = self.slot[index]
+        if self.momentum > 0:
+            value[seen] = (self.momentum * self.value[slot[seen]]
+                           + (1 - self.momentum) * value[seen])
+        self.value[slot] = value
+        self.stamp[slot] = self.clock
+
+    def fetch(self, index, compute, device=None):
+        r"""Returns the summaries of the distinct ids :obj:`index` on
+        :obj:`device`, after writing :obj:`compute()` for all of them if any
+        is stale."""
+        if bool(self.stale(index).any()):
+            self.write(index, compute())
+        value = self.value[self.slot[index.cpu()]]
+        return value if device is None else value.to(device)
+
+    def __repr__(self):
+        return (f'{self.__class__.__name__}({self.slot.numel()}, '
+                f'{self.value.size(1)}, rows={self.size}, '
+                f'staleness={self.staleness})')
@@ -1,15 +1,19 @@
 import math
 import torch
 import torch.nn.functional as F
-from tqdm import tqdm
 from torch_scatter import scatter_max, scatter
-from ogb.nodeproppred import PygNodePropPredDataset, Evaluator
-from torch_geometric.loader import NeighborSampler
+from ogb.nodeproppred import PygNodePropPredDataset
 from torch_geometric.nn import SAGEConv
-from copy import deepcopy
 import numpy as np
 import sys
-from utils import set_seeds, ns_graph_aug
+from utils import set_seeds, ns_graph_aug, AutoR
+from loss import jsd_loss
+from store import GraphStore
+from csr import CSRGraph, CSRNeighborSampler
+from inference import InferenceEngine, AccuracySink, AsyncEvaluator, ProgressBar
+from features import FeatureStore, CachedFeatureStore
+from memory import MomentumEncoder, SummaryBank
+from torch_geometric.data import Data
 from torch_geometric.utils import add_remaining_self_loops
 
 
@@ -37,28 +41,100 @@ parser.add_argument('--par', type=float, default=1, help='对比损失系数')
 parser.add_argument('--lam', type=float, default=0.01, help='约束损失系数')
 parser.add_argument('--limt', type=float, default=0.0001, help='约束损失率')
 
+parser.add_argument('--aug_workers', action='store_true',
+                    help='build augmented views inside the loader workers')
+parser.add_argument('--prefetch', type=int, default=2,
+                    help='batches prefetched per loader worker')
+parser.add_argument('--fused', action='store_true',
+                    help='run the clean and augmented views as one disjoint-union graph per layer')
+parser.add_argument('--memory', action='store_true',
+                    help='contrast the augmented view with clean summaries of a momentum encoder, '
+                         'kept in a memory bank, instead of training on the clean view')
+parser.add_argument('--momentum', type=float, default=0.99,
+                    help='EMA decay of the momentum encoder')
+parser.add_argument('--bank_momentum', type=float, default=0.,
+                    help='weight of a stored summary when it is recomputed (0 overwrites it)')
+parser.add_argument('--staleness', type=int, default=0,
+                    help='steps a stored summary is reused before it is recomputed')
+
+parser.add_argument('--store', type=str, default=None,
+                    help='directory of the compiled graph store (built on first use)')
+parser.add_argument('--features', type=str, default='fp32',
+                    choices=['fp32', 'fp16', 'int8'],
+                    help='storage type of the node features (fp16/int8 are memory-mapped)')
+parser.add_argument('--cache_size', type=int, default=0,
+                    help='feature rows of the highest-degree nodes kept in memory (0 disables)')
+parser.add_argument('--cache_policy', type=str, default='static',
+                    choices=['static', 'lru'], help='replacement policy of the feature cache')
+parser.add_argument('--eval_batch_size', type=int, default=4096,
+                    help='target nodes per batch of layer-wise inference')
+parser.add_argument('--eval_buffer', type=str, default=None,
+                    help='directory of the memory-mapped inference buffers (system temp if unset)')
+parser.add_argument('--eval_backend', type=str, default='sampler',
+                    choices=['sampler', 'spmm'],
+                    help='layer-wise inference on sampled batches, or as CPU CSR SpMM over row blocks')
+parser.add_argument('--eval_threads', type=int, default=1,
+                    help='row blocks the spmm backend processes concurrently')
+parser.add_argument('--eval_splits', type=str, default='train,valid,test',
+                    help='splits evaluated every test_freq epochs; without test, test is '
+                         'evaluated only when valid improves')
+parser.add_argument('--async_eval', action='store_true',
+                    help='evaluate weight snapshots in a background thread while training goes on')
+parser.add_argument('--cpu_features', action='store_true',
+                    help='keep the node features on the host and gather them per batch')
+
 
 args = parser.parse_args()
+eval_splits = args.eval_splits.split(',')
+assert 'valid' in eval_splits
 seed = args.seed
 set_seeds(seed)
 print(args)
 
-dataset = PygNodePropPredDataset('ogbn-products')
-split_idx = dataset.get_idx_split()
-evaluator = Evaluator(name='ogbn-products')
-data = dataset[0]
+if args.store is not None:
+    # Self-looped CSR, features, labels and split masks, memory-mapped; the
+    # samplers take the CSR as is instead of rebuilding it from `edge_index`.
+    dataset = GraphStore.open(args.store, 'ogbn-products', self_loops=True)
+    split_idx = dataset.split_idx()
+    data = Data(x=dataset.x, y=dataset.y)
+    graph = dataset.csr()
+else:
+    dataset = PygNodePropPredDataset('ogbn-products')
+    split_idx = dataset.get_idx_split()
+    data = dataset[0]
+    data.edge_index, _ = add_remaining_self_loops(data.edge_index)
+    graph = CSRGraph.from_edge_index(data.edge_index, data.num_nodes)
+    data.edge_index = None
+    # `data` shares its tensors with the dataset, which would keep the int64
+    # `edge_index` alive for the whole run.
+    dataset._data.edge_index = None
 
 train_idx = split_idx['train']
 test_idx = split_idx['test']
-data.edge_index, _ = add_remaining_self_loops(data.edge_index)
-train_loader = NeighborSampler(data.edge_index, node_idx=train_idx,
-                               sizes=[24, 8, 4], batch_size=args.batch_size,
-                               shuffle=True, num_workers=args.num_workers)
-
-
-subgraph_loader = NeighborSampler(data.edge_index, node_idx=None, sizes=[-1],
-                                  batch_size=4096, shuffle=False,
-                                  num_workers=args.num_workers)
+# AutoR publishes the rate here so that loader workers can read it.
+shared_rate = torch.full((1, ), args.rate, dtype=torch.double).share_memory_()
+loader_kwargs = {}
+if args.aug_workers:
+    # The edge-dropped view is drawn while sampling, in the same pass.
+    loader_kwargs['drop_rate'] = shared_rate
+    if args.num_workers > 0:
+        loader_kwargs['prefetch_factor'] = args.prefetch
+# Both loaders sample from the same int32 CSR.
+train_loader = CSRNeighborSampler(graph, node_idx=train_idx,
+                                  sizes=[24, 8, 4], batch_size=args.batch_size,
+                                  shuffle=True, num_workers=args.num_workers,
+                                  **loader_kwargs)
+
+
+# Under --async_eval the engine runs in a background thread while the main
+# thread trains, where forking loader workers can deadlock and a progress
+# bar would garble the training log.
+engine = InferenceEngine(graph, batch_size=args.eval_batch_size,
+                         num_workers=0 if args.async_eval else args.num_workers,
+                         buffer_dir=args.eval_buffer,
+                         progress=None if args.async_eval else ProgressBar(),
+                         backend=args.eval_backend,
+                         num_threads=args.eval_threads)
 
 
 class SAGE(torch.nn.Module):
@@ -106,33 +182,45 @@ class SAGE(torch.nn.Module):
 
         return x.log_softmax(dim=-1), x, out
 
-    def inference(self, x_all):
-        pbar = tqdm(total=x_all.size(0) * self.num_layers)
-        pbar.set_description('Evaluating')
+    def forward_pair(self, x, adjs, adja):
+        # Both views in one pass: every layer stacks the bipartite graphs of
+        # the augmented and the clean view (in that order) as one disjoint
+        # union and runs a single SAGEConv over it. Both views read the same
+        # input features, so the first layer keeps one copy of its sources.
+        shared = True
+        for i, (adj, aug) in enumerate(zip(adjs, adja)):
+            num_src, num_dst = adj.size
+            if shared:
+                x_target = x[:num_dst].repeat(2, 1)
+                offset = [[0], [num_dst]]
+            else:
+                x_target = torch.cat([x[:num_dst], x[num_src:num_src + num_dst]])
+                offset = [[num_src], [num_dst]]
+            edge_index = torch.cat(
+                [aug.edge_index, adj.edge_index + adj.edge_index.new_tensor(offset)],
+                dim=1)
+            if i == self.num_layers - 1:
+                out = (x, x) if shared else x.chunk(2)
 
-        # Compute representations of nodes layer by layer, using *all*
-        # available edges. This leads to faster computation in contrast to
-        # immediately computing the final representations of each batch.
-        total_edges = 0
-        for i in range(self.num_layers):
-            xs = []
-            for batch_size, n_id, adj in subgraph_loader:
-                edge_index, _, size = adj.to(device)
-                total_edges += edge_index.size(1)
-                x = x_all[n_id].to(device)
-                x_target = x[:size[1]]
-                x = self.convs[i]((x, x_target), edge_index)
-                if i != self.num_layers - 1:
-                    x = F.relu(x)
-                xs.append(x.cpu())
+            x = self.convs[i]((x, x_target), edge_index)
+            shared = False
 
-                pbar.update(batch_size)
+            if i != self.num_layers - 1:
 
-            x_all = torch.cat(xs, dim=0)
+                x = F.relu(x)
+                x = F.dropout(x, p=0.5, training=self.training)
 
-        pbar.close()
+        x = x.chunk(2)
+        return tuple((h.log_softmax(dim=-1), h, g) for h, g in zip(x, out))
 
-        return x_all
+    def inference(self, x_all, targets=None, sink=None):
+        # Compute representations of nodes layer by layer, using *all*
+        # available edges. This leads to faster computation in contrast to
+        # immediately computing the final representations of each batch.
+        # Every layer is streamed into a memory-mapped buffer, and only runs
+        # on the receptive field of `targets` if given; the last layer is fed
+        # to `sink` instead if given.
+        return engine.run(self.convs, x_all, device, targets, sink)
 
     def negsam_loss(self, z1, z2, neg_mask):
 
@@ -150,26 +238,22 @@ class SAGE(torch.nn.Module):
         loss = -torch.log(value_zi / value_mu)
         return loss
 
-    def jsd_loss(self, enc1, enc2, pos_mask, neg_mask):
-        logits = enc1 @ enc2.t()
-        Epos = (np.log(2.) - F.softplus(- logits))
-        Eneg = (F.softplus(-logits) + logits - np.log(2.))
-        #print("x:",enc1.shape,"g:",enc2.shape,"pos:",pos_mask.shape,"neg:",neg_mask.shape)
-        Epos = (Epos * pos_mask).sum() / pos_mask.sum()
-        Eneg = (Eneg * neg_mask).sum() / neg_mask.sum()
-        return Eneg - Epos
+    def jsd_loss(self, enc1, enc2, label):
+        # Pairs with equal labels are positives; logits are built tile by
+        # tile, so no B x B masks are allocated.
+        return jsd_loss(enc1, enc2, label)
 
     def projection(self, z):
         z = F.elu(self.fc1(z))
         return self.fc2(z)
 
-    def cl_lossaug(self, z1, g2, pos_mask, neg_mask):
+    def cl_lossaug(self, z1, g2, label):
         h1 = self.projection(z1)
         #h2 = self.projection(z2)
         h1 = F.normalize(h1)
         #h2 = F.normalize(h2)
 
-        ret = model.jsd_loss(h1, g2, pos_mask, neg_mask)
+        ret = model.jsd_loss(h1, g2, label)
 
         ret = ret.mean()
 
@@ -179,8 +263,24 @@ device = f'cuda:{args.device}' if torch.cuda.is_available() else 'cpu'
 device = torch.device(device)
 model = SAGE(dataset.num_features, args.hidden_channels, dataset.num_classes, args.num_layers)
 model = model.to(device)
-
-x = data.x.to(device)
+memory = None
+if args.memory:
+    memory = (MomentumEncoder(model, args.momentum),
+              SummaryBank(data.y.size(0), args.hidden_channels,
+                          args.bank_momentum, args.staleness))
+
+# Batches gather their node features from the feature store, which lives
+# on `device` unless it does not fit there; a feature cache implies the
+# store stays on the host.
+features = FeatureStore.open(dataset.processed_dir, data.x, args.features)
+# Evaluation reads the uncached store, so that full-graph passes neither
+# evict the hot rows nor count into the hit rate of training.
+eval_features = features
+if args.cache_size > 0:
+    features = CachedFeatureStore(features, args.cache_size, graph.degree(),
+                                  args.cache_policy)
+elif not args.cpu_features:
+    features = eval_features = features.to(device)
 y = data.y.squeeze().to(device)
 
 
@@ -194,7 +294,8 @@ def graph_em(g, neighbor, cluster):
     return graph_embedding
 
 
-def train_products(model, clean, y, adjs, adja, args, optimizer, device, criterion, train_idx=None) :
+def train_products(model, clean, y, adjs, adja, args, optimizer, device, criterion, train_idx=None,
+                   n_id=None, memory=None) :
     model.train()
     cluster = adjs[2][0][1]
     neighbor = adjs[2][0][0]
@@ -207,20 +308,31 @@ def train_products(model, clean, y, adjs, adja, args, optimizer, device, criteri
     optimizer.zero_grad()
 
 
-    out, x1, g1 = model_forward1(clean)
-    aug_pre, x2, g2 = model_forward2(clean)
+    if memory is not None:
+        # Only the augmented view is trained; the clean summaries of the
+        # batch nodes come from the bank, recomputed without gradients by the
+        # momentum encoder once they are stale.
+        target, bank = memory
+        aug_pre, x2, g2 = model_forward2(clean)
+        out = aug_pre
+        g1 = bank.fetch(n_id[:y.numel()], lambda: graph_em(
+            target(clean, adjs)[2], neighbor, cluster), device)
 
-    g1 = graph_em(g1, neighbor, cluster)
-    g2 = graph_em(g2, neighbor, cluster)
+        loss_cl = model.cl_lossaug(x2, g1, y) / 5
+    else:
+        if args.fused:
+            (aug_pre, x2, g2), (out, x1, g1) = model.forward_pair(clean, adjs, adja)
+        else:
+            out, x1, g1 = model_forward1(clean)
+            aug_pre, x2, g2 = model_forward2(clean)
 
-    label = y.contiguous().view(-1,1)
+        g1 = graph_em(g1, neighbor, cluster)
+        g2 = graph_em(g2, neighbor, cluster)
 
-    pos_mask = torch.eq(label, label.T).float().to(device)
-    neg_mask = 1 - pos_mask
-    loss1 = model.cl_lossaug(x1, g2, pos_mask, neg_mask)
-    loss2 = model.cl_lossaug(x2, g1, pos_mask, neg_mask)
+        loss1 = model.cl_lossaug(x1, g2, y)
+        loss2 = model.cl_lossaug(x2, g1, y)
 
-    loss_cl = (loss1 + loss2) / 10
+        loss_cl = (loss1 + loss2) / 10
 
     loss_train = criterion(aug_pre, y)
     loss = loss_train + args.par * loss_cl
@@ -239,46 +351,45 @@ def train_products(model, clean, y, adjs, adja, args, optimizer, device, criteri
     #     loss /= args.m
     loss.backward()
     optimizer.step()
+    if memory is not None:
+        target.update(model)
+        bank.step()
 
     #print(f'Batch:{i},loss_train:{loss_train}, loss_cl:{loss_cl}, loss:{loss}')
 
     return loss_train, out, aug_loss
 
 
-def train(epoch,  args):
+def train(epoch,  args, autor):
     total_loss = total_correct = 0
     # rate = [1/2, 1/4, 1/6]
     # rate = 1/2
-    rate = args.rate
-    print("rate:", rate)
-    aug = []
+    print("rate:", autor.rate)
+    if args.cache_size > 0:
+        features.reset_stats()
     i=0
 
-    for batch_size, n_id, adjs in train_loader:
+    for batch in train_loader:
         # `adjs` holds a list of `(edge_index, e_id, size)` tuples.
         i = i + 1
 
-        adjs = [adj.to(device) for adj in adjs]
-
-        adj_aug = deepcopy(adjs)
-        adja = ns_graph_aug(adj_aug, device, rate)
+        if args.aug_workers:
+            batch_size, n_id, adjs, adja = batch
+            adja = [adj.to(device) for adj in adja]
+            adjs = [adj.to(device) for adj in adjs]
+        else:
+            batch_size, n_id, adjs = batch
+            adjs = [adj.to(device) for adj in adjs]
+            adja = ns_graph_aug(adjs, autor.rate)
 
         # print("rate1", rate)
 
-        clean = x[n_id]
+        clean = features.gather(n_id, device)
 
         loss, out, aug_loss = train_products(model, clean, y[n_id[:batch_size]], adjs, adja, args, optimizer, device,
-                                          F.nll_loss)
-
-        aug.append(aug_loss)
-        # print("aug_loss:", aug_loss)
+                                          F.nll_loss, n_id=n_id, memory=memory)
 
-        if i >= 2:
-            if aug[i - 1] < aug[i - 2]:
-                rate = rate + args.limt * (aug[i - 2] - aug[i - 1])
-
-            elif aug[i - 1] > aug[i - 2]:
-                rate = rate - args.limt * (aug[i - 1] - aug[i - 2])
+        autor.step(aug_loss)
 
         # print("rate2", rate)
 
@@ -290,8 +401,10 @@ def train(epoch,  args):
     loss = total_loss / len(train_loader)
     approx_acc = total_correct / train_idx.size(0)
 
-    rate_epoch = rate
+    rate_epoch = autor.end_epoch()
     print('rate_epoch:', rate_epoch)
+    if args.cache_size > 0:
+        print(features)
     print(args.limt)
     with open('./rate_productsage.txt', 'a', encoding='utf-8') as f:
             f.write("%.4f" % rate_epoch)
@@ -304,49 +417,64 @@ def train(epoch,  args):
 
 
 @torch.no_grad()
-def test():
+def test(model, splits=('train', 'valid', 'test')):
     model.eval()
 
-    out = model.inference(x)
+    # Only the receptive field of the requested splits is computed, and the
+    # predictions are counted per split as they come out of the last layer;
+    # the other splits are reported as nan.
+    masks = {}
+    for key in splits:
+        masks[key] = torch.zeros(y.numel(), dtype=torch.bool)
+        masks[key][split_idx[key]] = True
+    targets = None
+    if len(splits) < 3:
+        targets = torch.cat([split_idx[key] for key in splits])
+    sink = model.inference(eval_features, targets,
+                           AccuracySink(y.cpu(), masks))
+
+    return tuple(sink.accuracy(key) if key in splits else float('nan')
+                 for key in ['train', 'valid', 'test'])
 
-    y_true = y.cpu().unsqueeze(-1)
-    y_pred = out.argmax(dim=-1, keepdim=True)
-    # test_loss = F.nll_loss(out, y)
-    # print(test_loss)
-    train_acc = evaluator.eval({
-        'y_true': y_true[split_idx['train']],
-        'y_pred': y_pred[split_idx['train']],
-    })['acc']
-    val_acc = evaluator.eval({
-        'y_true': y_true[split_idx['valid']],
-        'y_pred': y_pred[split_idx['valid']],
-    })['acc']
-    test_acc = evaluator.eval({
-        'y_true': y_true[split_idx['test']],
-        'y_pred': y_pred[split_idx['test']],
-    })['acc']
 
+def report(epoch, tra, val, tst):
+    print(f'Epoch:{epoch}, train:{tra:.6f}, val:{val:.6f}, test:{tst:.6f}')
 
-    return train_acc, val_acc, test_acc
 
+if args.async_eval:
+    async_eval = AsyncEvaluator(model, test, eval_splits, report)
 
 vals, tests = [], []
 for run in range(args.runs):
     best_val, final_test = 0, 0
 
     model.reset_parameters()
+    if memory is not None:
+        memory[0].reset(model)
+        memory[1].reset()
     optimizer = torch.optim.Adam(model.parameters(), lr=args.lr)
     args.rate = 0.5
+    autor = AutoR(args.rate, args.limt, mode='linear', shared=shared_rate)
     for epoch in range(1, args.epochs+1):
-        loss, acc, rate_epoch= train(epoch, args)
+        loss, acc, rate_epoch= train(epoch, args, autor)
         args.rate = rate_epoch
+        if args.async_eval:
+            async_eval.poll()
         if epoch >100 and epoch % args.test_freq == 0 or epoch == args.epochs:
-            result = test()
+            if args.async_eval:
+                async_eval.submit(epoch, model)
+                continue
+            result = test(model, eval_splits)
             tra, val, tst = result
-            print(f'Epoch:{epoch}, train:{tra:.6f}, val:{val:.6f}, test:{tst:.6f}')
+            report(epoch, tra, val, tst)
             if val > best_val:
                 best_val = val
+                if 'test' not in eval_splits:
+                    tst = test(model, ['test'])[2]
                 final_test = tst
+    if args.async_eval:
+        best_val, final_test = async_eval.join()
+        async_eval.reset()
     print(f'Run{run} val:{best_val:.6f}, test:{final_test:.6f}')
     vals.append(best_val)
     tests.append(final_test)
@@ -0,0 +1,196 @@
+import sys
+import os.path as osp
+
+import torch
+import torch.utils.data
+
+from cache import csr_key, save_arrays, load_arrays
+from csr import transposed_adj
+
+
+class GraphSAINTRandomWalkSampler(torch.utils.data.DataLoader):
+    r"""The GraphSAINT random walk sampler from the `"GraphSAINT: Graph
+    Sampling Based Inductive Learning Method"
+    <https://arxiv.org/abs/1907.04931>`_ paper, walking directly on a shared
+    :class:`csr.CSRGraph` instead of a private copy of the adjacency.
+
+    Mini-batches are sampled inside the loader worker processes, each
+    drawing from its own random stream, and carry the global ids of their
+    nodes as :obj:`n_id`. An optional :obj:`transform` is applied there as
+    well, e.g. :class:`utils.PairAug` to build augmented views while the
+    trainer is busy with the previous batch.
+
+    If :obj:`sample_coverage > 0`, the node and edge normalization
+    coefficients :obj:`node_norm` and :obj:`edge_norm` of the paper are
+    attached to every mini-batch. They are estimated once, with the same
+    number of workers, and saved to :obj:`save_dir`, so that later runs only
+    memory-map them.
+
+    Args:
+        graph (csr.CSRGraph): The graph to sample from.
+        data (torch_geometric.data.Data): The node-level attributes (labels,
+            masks, ...) sliced into every mini-batch.
+        batch_size (int): The number of walks to sample per mini-batch.
+        walk_length (int): The length of each random walk.
+        num_steps (int, optional): The number of iterations per epoch.
+            (default: :obj:`1`)
+        sample_coverage (int, optional): How many samples per node should be
+            used to compute normalization statistics. (default: :obj:`0`)
+        save_dir (string, optional): If set, will save the normalization
+            statistics to the :obj:`save_dir` directory for faster re-use.
+            The cache is keyed by a hash of the graph and the sampling
+            parameters. (default: :obj:`None`)
+        features (features.FeatureStore, optional): If set, the node
+            features :obj:`x` of every mini-batch are gathered from it.
+            (default: :obj:`None`)
+        transform (callable, optional): A function/transform that takes in
+            a mini-batch and returns a transformed version.
+            (default: :obj:`None`)
+        log (bool, optional): If set to :obj:`False`, will not log any
+            pre-processing progress. (default: :obj:`True`)
+        adj_t (bool, optional): If set to :obj:`True`, mini-batches carry
+            their edges as a transposed :class:`torch_sparse.SparseTensor`
+            :obj:`adj_t` instead of :obj:`edge_index`, and :obj:`edge_norm`
+            follows its non-zeros. (default: :obj:`False`)
+        **kwargs (optional): Additional arguments of
+            :class:`torch.utils.data.DataLoader`, such as :obj:`num_workers`.
+    """
+    def __init__(self, graph, data, batch_size, walk_length, num_steps=1,
+                 sample_coverage=0, save_dir=None, features=None,
+                 transform=None, log=True, adj_t=False, **kwargs):
+        self.graph = graph
+        self.data = data
+        self.walk_length = walk_length
+        self.num_steps = num_steps
+        self.sample_coverage = sample_coverage
+        self.features = features
+        self.transform = transform
+        self.adj_t = adj_t
+        self.N = graph.num_nodes
+        self._batch_size = batch_size
+
+        # Random stream and relabeling table of the current process.
+        self.rng_seed = self.rng = None
+        self.assoc = None
+
+        self.node_norm = self.edge_norm = None
+        if sample_coverage > 0:
+            key = csr_key(graph.rowptr, graph.col)
+            filename = (f'saint_rw_{batch_size}_{walk_length}_'
+                        f'{sample_coverage}_{key}')
+            path = osp.join(save_dir or '', filename)
+            if save_dir is not None and osp.exists(path):
+                self.node_norm, self.edge_norm = load_arrays(
+                    path, 'node_norm', 'edge_norm')
+            else:
+                self.node_norm, self.edge_norm = self.__compute_norm__(
+                    kwargs.get('num_workers', 0), log)
+                if save_dir is not None:
+                    save_arrays(path, node_norm=self.node_norm,
+                                edge_norm=self.edge_norm)
+
+        super().__init__(range(num_steps), batch_size=1,
+                         collate_fn=self.__collate__, **kwargs)
+
+    def __rng__(self):
+        # Workers are seeded apart by the DataLoader; the main process keeps
+        # one stream for the lifetime of the sampler.
+        info = torch.utils.data.get_worker_info()
+        seed = torch.initial_seed() if info is None else info.seed
+        if self.rng is None or self.rng_seed != seed:
+            self.rng_seed = seed
+            self.rng = torch.Generator()
+            self.rng.manual_seed(seed)
+        return self.rng
+
+    def __sample__(self, *args):
+        # Nodes visited by `batch_size` random walks from uniform roots, and
+        # the edges of the subgraph they induce as (target, source, CSR
+        # position).
+        generator = self.__rng__()
+        if self.assoc is None:
+            self.assoc = torch.full((self.N, ), -1, dtype=torch.long)
+        rowptr, col = self.graph.rowptr, self.graph.col
+
+        node = torch.randint(self.N, (self._batch_size, ), generator=generator)
+        walks = [node]
+        for _ in range(self.walk_length):
+            start = rowptr[node]
+            deg = rowptr[node + 1] - start
+            offset = (torch.rand(node.numel(), generator=generator)
+                      * deg).long()
+            offset = torch.minimum(offset, (deg - 1).clamp(min=0))
+            pos = (start + offset).clamp(max=self.graph.num_edges - 1)
+            # Nodes without neighbors stay where they are.
+            node = torch.where(deg > 0, col[pos].long(), node)
+            walks.append(node)
+        node_idx = torch.cat(walks).unique()
+
+        row, e_id = self.graph.sample(node_idx, -1)
+        self.assoc[node_idx] = torch.arange(node_idx.numel())
+        src = self.assoc[col[e_id].long()]
+        self.assoc[node_idx] = -1
+        mask = src >= 0
+        return node_idx, row[mask], src[mask], e_id[mask]
+
+    def __collate__(self, data_list):
+        node_idx, row, col, e_id = self.__sample__()
+
+        data = self.data.__class__()
+        data.num_nodes = node_idx.numel()
+        edge_index = torch.stack([col, row], dim=0)
+        if self.adj_t:
+            data.adj_t, perm = transposed_adj(edge_index, node_idx.numel())
+            e_id = e_id[perm]
+        else:
+            data.edge_index = edge_index
+
+        for key, item in self.data:
+            if key in ['edge_index', 'adj_t', 'num_nodes']:
+                continue
+            if isinstance(item, torch.Tensor) and item.size(0) == self.N:
+                data[key] = item[node_idx]
+            else:
+                data[key] = item
+
+        data.n_id = node_idx
+        if self.features is not None:
+            data.x = self.features[node_idx]
+        if self.node_norm is not None:
+            data.node_norm = self.node_norm[node_idx]
+            data.edge_norm = self.edge_norm[e_id]
+
+        return data if self.transform is None else self.transform(data)
+
+    def __compute_norm__(self, num_workers, log=True):
+        node_count = torch.zeros(self.N, dtype=torch.float)
+        edge_count = torch.zeros(self.graph.num_edges, dtype=torch.float)
+
+        if log:  # pragma: no cover
+            print('Compute GraphSAINT normalization', file=sys.stderr)
+
+        loader = torch.utils.data.DataLoader(
+            range(max(num_workers, 1) * 4), batch_size=1,
+            collate_fn=self.__sample__, num_workers=num_workers,
+            persistent_workers=num_workers > 0)
+
+        num_samples = total_sampled_nodes = 0
+        while total_sampled_nodes < self.N * self.sample_coverage:
+            for node_idx, _, _, e_id in loader:
+                node_count[node_idx] += 1
+                edge_count[e_id] += 1
+                total_sampled_nodes += node_idx.numel()
+                num_samples += 1
+
+        # Edge `j -> i` is normalized by the visits of `j` over its own.
+        t = node_count[self.graph.col.long()]
+        edge_norm = (t / edge_count).clamp_(0, 1e4)
+        edge_norm[torch.isnan(edge_norm)] = 0.1
+
+        node_count[node_count == 0] = 0.1
+        node_norm = num_samples / node_count / self.N
+
+        if log:  # pragma: no cover
+            print('Done!', file=sys.stderr)
+
+        return node_norm, edge_norm
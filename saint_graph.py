@@ -6,21 +6,25 @@ os.environ['CUDA_LAUNCH_BLOCKING'] = '1'
 import argparse
 
 import torch
-from tqdm import tqdm
 import torch.nn.functional as F
 
-from torch_geometric.loader import GraphSAINTRandomWalkSampler, NeighborSampler
 from torch_geometric.nn import SAGEConv
 from torch_scatter import scatter_max, scatter
-from ogb.nodeproppred import PygNodePropPredDataset, Evaluator
-from torch_geometric.utils import degree
+from ogb.nodeproppred import PygNodePropPredDataset
 import math
 import random
 import numpy as np
-from copy import deepcopy
 from torch_geometric.utils import add_remaining_self_loops
 
-from utils import saint_graph_aug, set_seeds, permute_edges, adaptive_aug
+from utils import saint_graph_aug, set_seeds, permute_edges, adaptive_aug, AutoR
+from utils import PairAug, saint_anchors, saint_pair_aug, union_graphs
+from loss import jsd_loss
+from saint import GraphSAINTRandomWalkSampler
+from store import GraphStore
+from csr import CSRGraph
+from inference import InferenceEngine, AccuracySink, AsyncEvaluator, ProgressBar
+from features import FeatureStore, CachedFeatureStore
+from memory import MomentumEncoder, SummaryBank
 
 parser = argparse.ArgumentParser(description='OGBN-Products (GraphSaint)')
 parser.add_argument('--seed', type=int, default=777, help='Random seed.')
@@ -49,11 +53,58 @@ parser.add_argument('--rate', type=float, default=0.2, help='数据增强扰动
 parser.add_argument('--lam', type=float, default=0.01, help='约束损失系数')
 parser.add_argument('--limt', type=float, default=0.001, help='约束损失率')
 
+parser.add_argument('--aug_workers', action='store_true',
+                    help='build augmented views inside the loader workers')
+parser.add_argument('--prefetch', type=int, default=2,
+                    help='batches prefetched per loader worker')
+parser.add_argument('--fused', action='store_true',
+                    help='run the clean and augmented views as one disjoint-union graph per layer')
+parser.add_argument('--sparse', action='store_true',
+                    help='batches carry a transposed SparseTensor adj_t and layers propagate by SpMM')
+parser.add_argument('--memory', action='store_true',
+                    help='contrast the augmented view with clean summaries of a momentum encoder, '
+                         'kept in a memory bank, instead of training on the clean view')
+parser.add_argument('--momentum', type=float, default=0.99,
+                    help='EMA decay of the momentum encoder')
+parser.add_argument('--bank_momentum', type=float, default=0.,
+                    help='weight of a stored summary when it is recomputed (0 overwrites it)')
+parser.add_argument('--staleness', type=int, default=0,
+                    help='steps a stored summary is reused before it is recomputed')
+parser.add_argument('--sample_coverage', type=int, default=0,
+                    help='samples per node for the GraphSAINT normalization (0 disables); '
+                         'computed once and cached next to the dataset')
+
+parser.add_argument('--store', type=str, default=None,
+                    help='directory of the compiled graph store (built on first use)')
+parser.add_argument('--features', type=str, default='fp32',
+                    choices=['fp32', 'fp16', 'int8'],
+                    help='storage type of the node features (fp16/int8 are memory-mapped)')
+parser.add_argument('--cache_size', type=int, default=0,
+                    help='feature rows of the highest-degree nodes kept in memory (0 disables)')
+parser.add_argument('--cache_policy', type=str, default='static',
+                    choices=['static', 'lru'], help='replacement policy of the feature cache')
+parser.add_argument('--eval_batch_size', type=int, default=4096,
+                    help='target nodes per batch of layer-wise inference')
+parser.add_argument('--eval_buffer', type=str, default=None,
+                    help='directory of the memory-mapped inference buffers (system temp if unset)')
+parser.add_argument('--eval_backend', type=str, default='sampler',
+                    choices=['sampler', 'spmm'],
+                    help='layer-wise inference on sampled batches, or as CPU CSR SpMM over row blocks')
+parser.add_argument('--eval_threads', type=int, default=1,
+                    help='row blocks the spmm backend processes concurrently')
+parser.add_argument('--eval_splits', type=str, default='train,valid,test',
+                    help='splits evaluated every test_freq epochs; without test, test is '
+                         'evaluated only when valid improves')
+parser.add_argument('--async_eval', action='store_true',
+                    help='evaluate weight snapshots in a background thread while training goes on')
+
 
 
 
 
 args = parser.parse_args()
+eval_splits = args.eval_splits.split(',')
+assert 'valid' in eval_splits
 
 seed = args.seed
 set_seeds(seed)
@@ -62,18 +113,41 @@ print(args)
 device = f"cuda:{args.device}" if torch.cuda.is_available() else "cpu"
 device = torch.device(device)
 
-dataset = PygNodePropPredDataset(name='ogbn-products')
-split_idx = dataset.get_idx_split()
-data = dataset[0]
-if args.load_CL == 0:
-    print('yeah')
-    data.edge_index,_ = add_remaining_self_loops(data.edge_index)
-sampler_data = data
-# Convert split indices to boolean masks and add them to `data`.
-for key, idx in split_idx.items():
-    mask = torch.zeros(data.num_nodes, dtype=torch.bool)
-    mask[idx] = True
-    data[f'{key}_mask'] = mask
+if args.store is not None:
+    # Self-looped CSR, features, labels and split masks, memory-mapped.
+    dataset = GraphStore.open(args.store, 'ogbn-products',
+                              self_loops=args.load_CL == 0)
+    split_idx = dataset.split_idx()
+    data = dataset.to_data(edge_index=False)
+    graph = dataset.csr()
+else:
+    dataset = PygNodePropPredDataset(name='ogbn-products')
+    split_idx = dataset.get_idx_split()
+    data = dataset[0]
+    if args.load_CL == 0:
+        print('yeah')
+        data.edge_index,_ = add_remaining_self_loops(data.edge_index)
+    # Convert split indices to boolean masks and add them to `data`.
+    for key, idx in split_idx.items():
+        mask = torch.zeros(data.num_nodes, dtype=torch.bool)
+        mask[idx] = True
+        data[f'{key}_mask'] = mask
+    graph = CSRGraph.from_edge_index(data.edge_index, data.num_nodes)
+    # `data` shares its tensors with the dataset, which would keep the int64
+    # `edge_index` alive for the whole run.
+    dataset._data.edge_index = None
+# Training and evaluation both sample from the int32 CSR, so the int64
+# `edge_index` is no longer needed.
+data.edge_index = None
+# Mini-batches gather their node features from the feature store.
+features = FeatureStore.open(dataset.processed_dir, data.x, args.features)
+# Evaluation reads the uncached store, so that full-graph passes neither
+# evict the hot rows nor count into the hit rate of training.
+eval_features = features
+if args.cache_size > 0:
+    features = CachedFeatureStore(features, args.cache_size, graph.degree(),
+                                  args.cache_policy)
+data.num_nodes, data.x = features.num_nodes, None
 
 
 class SAGE(torch.nn.Module):
@@ -96,7 +170,9 @@ class SAGE(torch.nn.Module):
         for conv in self.convs:
             conv.reset_parameters()
 
-    def forward(self, x, edge_index):
+    def forward(self, x, edge_index, node_mask=None):
+        if node_mask is not None:
+            x = x * node_mask.view(-1, 1).to(x.dtype)
 
         for conv in self.convs[:-1]:
             out = conv(x, edge_index)
@@ -107,50 +183,39 @@ class SAGE(torch.nn.Module):
 
         return torch.log_softmax(x, dim=-1), out, g
 
-    def inference(self, x_all, subgraph_loader, device):
-        pbar = tqdm(total=x_all.size(0) * len(self.convs))
-        pbar.set_description('Evaluating')
-
-        for i, conv in enumerate(self.convs):
-            xs = []
-            for batch_size, n_id, adj in subgraph_loader:
-                edge_index, _, size = adj.to(device)
-                x = x_all[n_id].to(device)
-                x_target = x[:size[1]]
-                x = conv((x, x_target), edge_index)
-                if i != len(self.convs) - 1:
-                    x = F.relu(x)
-                xs.append(x.cpu())
-
-                pbar.update(batch_size)
+    def forward_pair(self, x, edge_index, node_mask):
+        # The augmented and the clean view as one graph of 2N nodes, the
+        # augmented one first, so that every layer runs one SAGEConv over
+        # both; the outputs are split back per view.
+        N = x.size(0)
+        x = torch.cat([x * node_mask.view(-1, 1).to(x.dtype), x], dim=0)
+        edge_index = union_graphs(edge_index, edge_index, N)
+        pre, out, g = self(x, edge_index)
+        return tuple(zip(pre.split(N), out.split(N), g.split(N)))
 
-            x_all = torch.cat(xs, dim=0)
+    def inference(self, x_all, engine, device, targets=None, sink=None):
+        # Layer by layer over *all* edges (or the receptive field of
+        # `targets`); the engine streams every layer into a memory-mapped
+        # buffer, or fed to `sink` for the last layer.
+        return engine.run(self.convs, x_all, device, targets, sink)
 
-        pbar.close()
 
-        return x_all
-
-
-    def jsd_loss(self, enc1, enc2, pos_mask, neg_mask):
-        logits = enc1 @ enc2.t()
-        Epos = (np.log(2.) - F.softplus(- logits))
-        Eneg = (F.softplus(- logits) + logits - np.log(2.))
-        # print("x:",enc1.shape,"g:",enc2.shape,"pos:",pos_mask.shape,"neg:",neg_mask.shape)
-        Epos = (Epos * pos_mask).sum() / pos_mask.sum()
-        Eneg = (Eneg * neg_mask).sum() / neg_mask.sum()
-        return Eneg - Epos
+    def jsd_loss(self, enc1, enc2, label):
+        # Pairs with equal labels are positives; logits are built tile by
+        # tile, so no B x B masks are allocated.
+        return jsd_loss(enc1, enc2, label)
 
     def projection(self, z):
         z = F.elu(self.fc1(z))
         return self.fc2(z)
 
-    def cl_lossaug(self, z1, g2, pos_mask, neg_mask):
+    def cl_lossaug(self, z1, g2, label):
         #h1 = self.projection(z1)
         # h2 = self.projection(z2)
         #h1 = F.normalize(h1)
         # h2 = F.normalize(h2)
 
-        ret = model.jsd_loss(z1, g2, pos_mask, neg_mask)
+        ret = model.jsd_loss(z1, g2, label)
 
         ret = ret.mean()
 
@@ -163,13 +228,21 @@ def graph_em(g, neighbor, cluster):
 
     return graph_embedding
 
-def train(model, loader, optimizer, device, epoch, args):
+def nll_loss(out, y, data):
+    # With `--sample_coverage`, training nodes are weighted by the GraphSAINT
+    # node normalization of the sampler.
+    if 'node_norm' not in data:
+        return F.nll_loss(out, y)
+    loss = F.nll_loss(out, y, reduction='none')
+    return (loss * data.node_norm[data.train_mask]).sum()
+
+def train(model, loader, optimizer, device, epoch, args, autor):
     model.train()
+    if args.cache_size > 0:
+        features.reset_stats()
     total_loss = total_correct = total_sim = total_aug = 0
     num = 0
     i=0
-    rate = args.rate
-    aug = []
     # rate_all = rate
     # total_augloss = args.augloss
 
@@ -178,51 +251,64 @@ def train(model, loader, optimizer, device, epoch, args):
         for data in loader:
             i=i+1
             # print("rate1", rate)
-            neighbor_edge = data.edge_index[:,:(data.edge_index[0]<data.train_mask.sum()).sum()]
-            neighbor = neighbor_edge[1].to(device)
-            cluster = neighbor_edge[0].to(device)
-            node_degree = degree(cluster,data.train_mask.sum())
+            if args.aug_workers:
+                data, view1 = data
+                view1 = view1.to(device)
+                data = view1.data
+                index, neighbor, cluster = view1.index, view1.neighbor, view1.cluster
+            else:
+                data = data.to(device)
+                index, neighbor, cluster = saint_anchors(data, args.topk)
+
+                # view1 = saint_graph_aug(data, rate, index, neighbor, cluster)
+                view1 = adaptive_aug(data, autor.rate, index, neighbor, cluster)
 
-            _, index = torch.topk(node_degree, args.topk)
-            data_aug = deepcopy(data)
-
-            # view1 = saint_graph_aug(data_aug, rate, index, neighbor, cluster)
-            view1 = adaptive_aug(data_aug, rate, index, neighbor, cluster)
-
-            view1 = view1.to(device)
-            data = data.to(device)
             optimizer.zero_grad()
 
             # rate = liner(view1[index])
 
 
-            aug_pre, x1, g1 = model(view1.x, view1.edge_index)
-            y_pre, x2, g2 = model(data.x, data.edge_index)
-
-            g1 = graph_em(g1, neighbor, cluster)
-            g2 = graph_em(g2, neighbor, cluster)
-
+            # Both views share the edges of the batch.
+            edge_index = data.adj_t if args.sparse else data.edge_index
             y = data.y.squeeze(1)[data.train_mask]
-            label = y[index].contiguous().view(-1, 1)
-            x1 = x1[index]
-            x2 = x2[index]
-            g1 = g1[index]
-            g2 = g2[index]
-
-            pos_mask = torch.eq(label, label.T).float().to(device)
-            neg_mask = 1 - pos_mask
-
-            loss1 = model.cl_lossaug(x1, g2, pos_mask, neg_mask)
-            loss2 = model.cl_lossaug(x2, g1, pos_mask, neg_mask)
-
-            loss_cl = (loss1 + loss2) / 10
+            label = y[index]
+            if args.memory:
+                # Only the augmented view is trained; the clean summaries of
+                # the anchors come from the bank, recomputed without
+                # gradients by the momentum encoder once they are stale.
+                aug_pre, x1, g1 = model(view1.x, edge_index, view1.node_mask)
+                g2 = bank.fetch(data.n_id[index], lambda: graph_em(
+                    target(data.x, edge_index)[2], neighbor, cluster)[index],
+                    device)
+
+                loss_cl = model.cl_lossaug(x1[index], g2, label) / 5
+            else:
+                if args.fused:
+                    (aug_pre, x1, g1), (y_pre, x2, g2) = model.forward_pair(
+                        data.x, edge_index, view1.node_mask)
+                else:
+                    aug_pre, x1, g1 = model(view1.x, edge_index, view1.node_mask)
+                    y_pre, x2, g2 = model(data.x, edge_index)
+
+                g1 = graph_em(g1, neighbor, cluster)
+                g2 = graph_em(g2, neighbor, cluster)
+
+                x1 = x1[index]
+                x2 = x2[index]
+                g1 = g1[index]
+                g2 = g2[index]
+
+                loss1 = model.cl_lossaug(x1, g2, label)
+                loss2 = model.cl_lossaug(x2, g1, label)
+
+                loss_cl = (loss1 + loss2) / 10
             # print("loss_cl:", loss_cl)
 
             #### 原始图loss | 增强图loss
             # out = y_pre[data.train_mask]
             out = aug_pre[data.train_mask]
 
-            loss_train = F.nll_loss(out, y)
+            loss_train = nll_loss(out, y, data)
             # print("loss_train:", loss_train)
             #
             # aug_pre = aug_pre[index]
@@ -242,36 +328,24 @@ def train(model, loader, optimizer, device, epoch, args):
             loss.backward()
             optimizer.step()
             total_loss += float(loss)
+            if args.memory:
+                target.update(model)
+                bank.step()
 
             # from sklearn.metrics.pairwise import cosine_similarity as cos
             #
             # sim = cos(g1.cpu().detach().numpy(),g2.cpu().detach().numpy())
             # total_sim += float(sim.mean())
 
-            aug.append(loss)
-
-
-            # print("aug_loss:", loss_train)
-            # if i>=3:
-            #     if aug[i-1] < aug[i-2]:
-            #         rate = rate
-            #     elif aug[i-1] > aug[i-2] and aug[i-2] > aug[i-3]:
-            #         rate = rate - args.limt*(aug[i-1] - aug[i-2])
-            #     else:
-            #         rate = rate + limt*(aug[i-1] - aug[is-2])
-            if i>=2:
-                if aug[i-1] < aug[i-2]:
-                    rate = rate + args.limt * torch.sigmoid(aug[i-2] - aug[i-1])
-                elif aug[i-1] > aug[i-2]:
-                    rate = rate - args.limt * torch.sigmoid(aug[i-1] - aug[i-2])
-                    # rate = rate
-            # rate_all = rate_all + rate
+            autor.step(loss)
 
 
 
         # print(i)
         loss = total_loss / len(loader)
-        rate_epoch = rate
+        rate_epoch = autor.end_epoch()
+        if args.cache_size > 0:
+            print(features)
         # sim = total_sim / len(loader)
         # print('sim:',sim)
         # print('rate:', rate)
@@ -293,15 +367,18 @@ def train(model, loader, optimizer, device, epoch, args):
         print("original")
         for data in loader:
             i = i + 1
-            a = data.edge_index.shape[1]/data.x.shape[0]
+            if args.aug_workers:
+                data = data[0]
+            a = data.num_edges/data.x.shape[0]
 
             data = data.to(device)
             optimizer.zero_grad()
-            y_pre, _,_ = model(data.x, data.edge_index)
+            edge_index = data.adj_t if args.sparse else data.edge_index
+            y_pre, _,_ = model(data.x, edge_index)
             out = y_pre[data.train_mask]
             y = data.y.squeeze(1)[data.train_mask]
 
-            loss_train = F.nll_loss(out, y)
+            loss_train = nll_loss(out, y, data)
             loss_train.backward()
             optimizer.step()
             total_loss += float(loss_train)
@@ -315,67 +392,108 @@ def train(model, loader, optimizer, device, epoch, args):
 
 
 @torch.no_grad()
-def test(model, data, evaluator, subgraph_loader, device):
+def test(model, data, features, engine, device,
+         splits=('train', 'valid', 'test')):
     model.eval()
 
-    out = model.inference(data.x, subgraph_loader, device)
-
-    y_true = data.y
-    y_pred = out.argmax(dim=-1, keepdim=True)
-
-    train_acc = evaluator.eval({
-        'y_true': y_true[data.train_mask],
-        'y_pred': y_pred[data.train_mask]
-    })['acc']
-    valid_acc = evaluator.eval({
-        'y_true': y_true[data.valid_mask],
-        'y_pred': y_pred[data.valid_mask]
-    })['acc']
-    test_acc = evaluator.eval({
-        'y_true': y_true[data.test_mask],
-        'y_pred': y_pred[data.test_mask]
-    })['acc']
-
-    return train_acc, valid_acc, test_acc
-
-loader = GraphSAINTRandomWalkSampler(sampler_data,
+    # Only the receptive field of the requested splits is computed, and the
+    # predictions are counted per split as they come out of the last layer;
+    # the other splits are reported as nan.
+    masks = {key: data[f'{key}_mask'] for key in splits}
+    targets = None
+    if len(splits) < 3:
+        targets = torch.stack(list(masks.values())).any(dim=0)
+    sink = model.inference(features, engine, device, targets,
+                           AccuracySink(data.y, masks))
+
+    return tuple(sink.accuracy(key) if key in splits else float('nan')
+                 for key in ['train', 'valid', 'test'])
+
+# AutoR publishes the rate here so that loader workers can read it.
+shared_rate = torch.full((1, ), args.rate, dtype=torch.double).share_memory_()
+loader_kwargs = {'num_workers': args.num_workers}
+if args.aug_workers:
+    loader_kwargs['transform'] = PairAug(saint_pair_aug, shared_rate, topk=args.topk)
+if args.num_workers > 0:
+    loader_kwargs['prefetch_factor'] = args.prefetch
+
+# Random walks are sampled in the loader workers, straight from the CSR.
+loader = GraphSAINTRandomWalkSampler(graph, data,
                                      batch_size=args.batch_size,
                                      walk_length=args.walk_length,
+                                     features=features,
                                      num_steps=args.num_steps,
-                                     sample_coverage=0,
-                                     save_dir=dataset.processed_dir)
+                                     sample_coverage=args.sample_coverage,
+                                     save_dir=dataset.processed_dir,
+                                     adj_t=args.sparse,
+                                     **loader_kwargs)
+
+# Under --async_eval the engine runs in a background thread while the main
+# thread trains, where forking loader workers can deadlock and a progress
+# bar would garble the training log.
+engine = InferenceEngine(graph, batch_size=args.eval_batch_size,
+                         num_workers=0 if args.async_eval else args.num_workers,
+                         buffer_dir=args.eval_buffer,
+                         progress=None if args.async_eval else ProgressBar(),
+                         backend=args.eval_backend,
+                         num_threads=args.eval_threads)
+
+model = SAGE(features.num_features, args.hidden_channels, dataset.num_classes,
+             args.num_layers, args.dropout).to(device)
+if args.memory:
+    target = MomentumEncoder(model, args.momentum)
+    bank = SummaryBank(features.num_nodes, args.hidden_channels,
+                       args.bank_momentum, args.staleness)
 
-subgraph_loader = NeighborSampler(data.edge_index, sizes=[-1],
-                                  batch_size=4096, shuffle=False,
-                                  num_workers=args.num_workers)
+def report(epoch, tra, val, tst):
+    print(f'Epoch:{epoch}, train:{tra}, val:{val}, test:{tst}')
 
-model = SAGE(data.x.size(-1), args.hidden_channels, dataset.num_classes,
-             args.num_layers, args.dropout).to(device)
 
-evaluator = Evaluator(name='ogbn-products')
+if args.async_eval:
+    async_eval = AsyncEvaluator(
+        model, lambda model, splits: test(model, data, eval_features,
+                                          engine, device, splits),
+        eval_splits, report)
+
 vals, tests = [], []
 for run in range(args.runs):
     best_val, final_test = 0, 0
 
     model.reset_parameters()
+    if args.memory:
+        target.reset(model)
+        bank.reset()
     optimizer = torch.optim.Adam(model.parameters(), lr=args.lr)
     args.rate = 0.2
+    autor = AutoR(args.rate, args.limt, mode='sigmoid', shared=shared_rate)
 
     for epoch in range(1, args.epochs + 1):
         print('epoch:', epoch)
         # loss, acc = train(model, loader, optimizer, device, epoch, args)
-        loss, acc, rate_u = train(model, loader, optimizer, device, epoch, args)
+        loss, acc, rate_u = train(model, loader, optimizer, device, epoch, args, autor)
         args.rate = rate_u
+        if args.async_eval:
+            async_eval.poll()
         if epoch > 100 and epoch % args.test_freq == 0 or epoch == args.epochs:
+            if args.async_eval:
+                async_eval.submit(epoch, model)
+                continue
 
-            result = test(model, data, evaluator, subgraph_loader, device)
+            result = test(model, data, eval_features, engine, device,
+                          eval_splits)
             tra, val, tst = result
-            print(f'Epoch:{epoch}, train:{tra}, val:{val}, test:{tst}')
+            report(epoch, tra, val, tst)
 
             if val > best_val:
                 best_val = val
+                if 'test' not in eval_splits:
+                    tst = test(model, data, eval_features, engine,
+                               device, ['test'])[2]
                 final_test = tst
 
+    if args.async_eval:
+        best_val, final_test = async_eval.join()
+        async_eval.reset()
     print(f'Run{run} val:{best_val}, test:{final_test}')
     vals.append(best_val)
     tests.append(final_test)
@@ -0,0 +1,139 @@
+import sys
+import json
+import os.path as osp
+
+import torch
+from torch_sparse import SparseTensor
+from torch_geometric.data import Data
+from torch_geometric.utils import add_remaining_self_loops
+
+from cache import save_arrays, load_arrays
+from csr import CSRGraph
+
+# Bump whenever the on-disk layout changes; stores of other versions live in
+# other directories and are never read.
+STORE_VERSION = 1
+
+SPLITS = ['train', 'valid', 'test']
+
+
+def compile_store(path, name='ogbn-products', self_loops=True, log=True):
+    r"""One-time conversion of an OGB node property prediction dataset into
+    a :class:`GraphStore` at :obj:`path`: the (optionally self-looped)
+    adjacency as a target-major CSR with :obj:`int32` columns where the
+    node count allows it, the node features, the labels and the split
+    masks, all as raw arrays."""
+    from ogb.nodeproppred import PygNodePropPredDataset
+
+    if log:  # pragma: no cover
+        print(f'Compiling {name} into {path}...', file=sys.stderr)
+
+    dataset = PygNodePropPredDataset(name=name)
+    split_idx = dataset.get_idx_split()
+    data = dataset[0]
+    N = data.num_nodes
+
+    edge_index = data.edge_index
+    if self_loops:
+        edge_index, _ = add_remaining_self_loops(edge_index, num_nodes=N)
+    # Row `i` lists the sources of the edges pointing to `i`, as in the
+    # `adj_t` of `NeighborSampler`.
+    rowptr, col, _ = SparseTensor(row=edge_index[1], col=edge_index[0],
+                                  sparse_sizes=(N, N)).csr()
+    if N < 2**31:
+        col = col.to(torch.int32)
+
+    masks = {}
+    for key in SPLITS:
+        mask = torch.zeros(N, dtype=torch.bool)
+        mask[split_idx[key]] = True
+        masks[f'{key}_mask'] = mask
+
+    meta = {
+        'version': STORE_VERSION,
+        'name': name,
+        'self_loops': self_loops,
+        'num_nodes': N,
+        'num_edges': col.numel(),
+        'num_features': data.x.size(-1),
+        'num_classes': dataset.num_classes,
+    }
+    save_arrays(path, meta=meta, rowptr=rowptr, col=col, x=data.x, y=data.y,
+                **masks)
+
+    if log:  # pragma: no cover
+        print('Done!', file=sys.stderr)
+
+
+class GraphStore(object):
+    r"""Read-only view of a graph compiled by :meth:`compile_store`. Every
+    array is memory-mapped, so opening the store takes seconds and the
+    pages are shared between all processes that open it.
+
+    Args:
+        path (string): The directory of the compiled store.
+    """
+    def __init__(self, path):
+        with open(osp.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        if meta['version'] != STORE_VERSION:
+            raise RuntimeError(f"'{path}' holds a version {meta['version']} "
+                               f"graph store, expected {STORE_VERSION}")
+
+        self.path = path
+        self.meta = meta
+        self.num_nodes = meta['num_nodes']
+        self.num_edges = meta['num_edges']
+        self.num_features = meta['num_features']
+        self.num_classes = meta['num_classes']
+
+        self.rowptr, self.col, self.x, self.y = load_arrays(
+            path, 'rowptr', 'col', 'x', 'y')
+        self.masks = dict(zip(SPLITS, load_arrays(
+            path, *[f'{key}_mask' for key in SPLITS])))
+
+    @classmethod
+    def open(cls, root, name='ogbn-products', self_loops=True):
+        r"""Opens the store of :obj:`name` under :obj:`root`, compiling it
+        first if it does not exist yet."""
+        loops_str = '_self_loops' if self_loops else ''
+        path = osp.join(root, f"{name.replace('-', '_')}{loops_str}"
+                              f'_v{STORE_VERSION}')
+        if not osp.exists(path):
+            compile_store(path, name, self_loops)
+        return cls(path)
+
+    @property
+    def processed_dir(self):
+        # Lets the trainers keep their other caches next to the store.
+        return self.path
+
+    def split_idx(self):
+        return {key: mask.nonzero(as_tuple=False).view(-1)
+                for key, mask in self.masks.items()}
+
+    def edge_index(self):
+        N = self.num_nodes
+        row = torch.repeat_interleave(torch.arange(N),
+                                      self.rowptr[1:] - self.rowptr[:-1])
+        return torch.stack([self.col.long(), row], dim=0)
+
+    def csr(self):
+        return CSRGraph(self.rowptr, self.col)
+
+    def adj_t(self):
+        N = self.num_nodes
+        return SparseTensor(rowptr=self.rowptr, col=self.col.long(),
+                            sparse_sizes=(N, N), is_sorted=True)
+
+    def to_data(self, edge_index=True):
+        # Trainers that sample from `csr()` can skip the int64 COO copy.
+        data = Data(x=self.x, y=self.y,
+                    edge_index=self.edge_index() if edge_index else None)
+        for key, mask in self.masks.items():
+            data[f'{key}_mask'] = mask
+        return data
+
+    def __repr__(self):
+        return (f'{self.__class__.__name__}({self.meta["name"]}, '
+                f'num_nodes={self.num_nodes}, num_edges={self.num_edges})')
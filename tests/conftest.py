@@ -0,0 +1,5 @@
+import os.path as osp
+import sys
+
+# The modules under test live flat in the repository root.
+sys.path.insert(0, osp.dirname(osp.dirname(osp.abspath(__file__))))
@@ -0,0 +1,99 @@
+import copy
+import os.path as osp
+
+import torch
+from torch_geometric.data import Data
+from torch_geometric.utils import coalesce
+from torch_sparse import SparseTensor, cat
+
+from cache import graph_key, save_arrays
+from cluster import ClusterData, ClusterLoader
+
+
+def random_cluster_data(save_dir, num_nodes=60, num_edges=300, num_parts=6):
+    torch.manual_seed(12345)
+    N = num_nodes
+    edge_index = coalesce(torch.randint(N, (2, num_edges)), num_nodes=N)
+    E = edge_index.size(1)
+    data = Data(edge_index=edge_index, x=torch.randn(N, 3),
+                y=torch.randint(5, (N, )), edge_attr=torch.randn(E, 2),
+                num_nodes=N)
+
+    # A random partition, with an empty part, in place of METIS, written
+    # where `ClusterData` looks for its cache.
+    perm = torch.randperm(N)
+    cuts = torch.randint(1, N, (num_parts - 2, )).sort()[0]
+    partptr = torch.cat([torch.tensor([0, 0]), cuts, torch.tensor([N])])
+    adj = SparseTensor(row=edge_index[0], col=edge_index[1],
+                       value=torch.arange(E), sparse_sizes=(N, N))
+    rowptr, col, value = adj.permute(perm).csr()
+    key = graph_key(edge_index, N, num_parts, False)
+    save_arrays(osp.join(save_dir, f'partition_{num_parts}_{key}'),
+                rowptr=rowptr, col=col, value=value, partptr=partptr,
+                perm=perm)
+    return ClusterData(data, num_parts, save_dir=save_dir, log=False)
+
+
+def baseline_collate(cluster_data, batch):
+    # `ClusterLoader.__collate__` before it was vectorized.
+    N = cluster_data.data.num_nodes
+    E = cluster_data.data.num_edges
+
+    start = cluster_data.partptr[batch].tolist()
+    end = cluster_data.partptr[batch + 1].tolist()
+    node_idx = torch.cat([torch.arange(s, e) for s, e in zip(start, end)])
+    node_cluster = torch.cat([torch.full([e - s], i)
+                              for i, (s, e) in enumerate(zip(start, end))])
+
+    data = copy.copy(cluster_data.data)
+    del data.num_nodes
+    adj, data.adj = cluster_data.data.adj, None
+    adj = cat([adj.narrow(0, s, e - s) for s, e in zip(start, end)], dim=0)
+    adj = adj.index_select(1, node_idx)
+    row, col, edge_idx = adj.coo()
+    data.edge_index = torch.stack([row, col], dim=0)
+
+    for key, item in data:
+        if isinstance(item, torch.Tensor) and item.size(0) == N:
+            data[key] = item[node_idx]
+        elif isinstance(item, torch.Tensor) and item.size(0) == E:
+            data[key] = item[edge_idx]
+        else:
+            data[key] = item
+    data['node_cluster'] = node_cluster
+    return data
+
+
+def sorted_edges(edge_index, edge_attr, num_nodes):
+    perm = (edge_index[0] * num_nodes + edge_index[1]).argsort()
+    return edge_index[:, perm], edge_attr[perm]
+
+
+def test_cluster_collate(tmp_path):
+    cluster_data = random_cluster_data(str(tmp_path))
+    x = cluster_data.data.x[cluster_data.perm.argsort()]
+    batches = [[0], [4, 1, 3], [5, 0, 2, 1], list(range(6))]
+
+    for adj_t in [False, True]:
+        loader = ClusterLoader(cluster_data, adj_t=adj_t)
+        for batch in batches:
+            expected = baseline_collate(cluster_data, torch.tensor(batch))
+            out = loader.__collate__(batch)
+            n = expected.node_cluster.numel()
+
+            assert torch.equal(out.node_cluster, expected.node_cluster)
+            assert torch.equal(out.y, expected.y)
+            assert torch.equal(out.x, expected.x)
+            assert torch.equal(out.x, x[out.n_id])
+            assert torch.equal(out.part, torch.tensor(batch))
+
+            if adj_t:
+                row, col, _ = out.adj_t.coo()
+                edge_index = torch.stack([col, row], dim=0)
+            else:
+                edge_index = out.edge_index
+            edge_index, edge_attr = sorted_edges(edge_index, out.edge_attr, n)
+            ref_index, ref_attr = sorted_edges(expected.edge_index,
+                                               expected.edge_attr, n)
+            assert torch.equal(edge_index, ref_index)
+            assert torch.equal(edge_attr, ref_attr)
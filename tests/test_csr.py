@@ -0,0 +1,67 @@
+import torch
+
+from csr import CSRGraph, CSRNeighborSampler
+
+
+def random_graph(num_nodes=50, num_edges=400):
+    torch.manual_seed(12345)
+    edge_index = torch.randint(num_nodes, (2, num_edges))
+    # A hub of high in-degree, next to nodes without any in-edge.
+    edge_index[1] %= num_nodes - 5
+    hub = torch.stack([torch.arange(num_nodes), torch.zeros(num_nodes).long()])
+    return CSRGraph.from_edge_index(torch.cat([edge_index, hub], dim=1),
+                                    num_nodes)
+
+
+def check_sample(graph, index, size):
+    row, e_id = graph.sample(index, size)
+    deg = graph.degree(index)
+    for i in range(index.numel()):
+        node = int(index[i])
+        sampled = e_id[row == i]
+        start, end = int(graph.rowptr[node]), int(graph.rowptr[node + 1])
+
+        # Only in-edges of the node, each at most once.
+        assert bool(((sampled >= start) & (sampled < end)).all())
+        assert sampled.unique().numel() == sampled.numel()
+        if size < 0 or deg[i] <= size:
+            assert torch.equal(sampled.sort()[0], torch.arange(start, end))
+        else:
+            assert sampled.numel() == size
+
+
+def test_sample():
+    graph = random_graph()
+    assert int(graph.degree().min()) == 0
+    index = torch.randperm(graph.num_nodes)
+    for size in [-1, 0, 1, 3, 8, 25]:
+        check_sample(graph, index, size)
+    check_sample(graph, index[:5], 4)
+
+
+def test_sample_uniform():
+    # Every edge of a node of in-degree 10 is drawn with probability 3 / 10.
+    torch.manual_seed(12345)
+    edge_index = torch.stack([torch.arange(10), torch.zeros(10).long()])
+    graph = CSRGraph.from_edge_index(edge_index, 10)
+    index = torch.zeros(4000, dtype=torch.long)
+    _, e_id = graph.sample(index, 3)
+    freq = torch.bincount(e_id, minlength=10).float() / index.numel()
+    assert torch.allclose(freq, torch.full((10, ), 0.3), atol=0.03)
+
+
+def test_drop_edges():
+    graph = random_graph()
+    loader = CSRNeighborSampler(graph, [6, 4, 3], batch_size=8)
+    _, _, adjs = next(iter(loader))
+    for rate in [-0.5, 0., 0.3, 1., 1.7]:
+        out = CSRNeighborSampler.drop_edges(adjs, rate)
+        for i, (adj, adja) in enumerate(zip(adjs, out)):
+            num = adj.edge_index.size(1)
+            drop = min(max(int(num * rate / (i + 1)), 0), num)
+            assert adja.e_id.numel() == num - drop
+            # A subset of the clean hop, in its order.
+            keep = (adj.e_id.view(-1, 1) == adja.e_id.view(1, -1)).any(dim=1)
+            assert torch.equal(adj.e_id[keep], adja.e_id)
+            assert torch.equal(adj.edge_index[:, keep], adja.edge_index)
+            assert adja.size == adj.size
@@ -0,0 +1,99 @@
+import ast
+import os.path as osp
+
+import torch
+
+from csr import CSRGraph, CSRNeighborSampler
+
+ROOT = osp.dirname(osp.dirname(osp.abspath(__file__)))
+
+
+def load_sage(filename):
+    # The trainers parse arguments and load their dataset on import, so only
+    # their imports and the `SAGE` class are executed.
+    path = osp.join(ROOT, filename)
+    with open(path) as f:
+        tree = ast.parse(f.read())
+    body = [node for node in tree.body
+            if isinstance(node, (ast.Import, ast.ImportFrom))
+            or (isinstance(node, ast.ClassDef) and node.name == 'SAGE')]
+    scope = {}
+    exec(compile(ast.Module(body, []), path, 'exec'), scope)
+    return scope['SAGE']
+
+
+def backward(model, outputs):
+    # Parameter gradients of a loss that weights every output differently.
+    model.zero_grad()
+    loss = sum((out.float() ** 2).sum() * (i + 1)
+               for i, out in enumerate(outputs))
+    loss.backward()
+    return [param.grad.clone() for param in model.parameters()
+            if param.grad is not None]
+
+
+def check_parity(model, two_calls, fused):
+    expected = two_calls()
+    grads = backward(model, expected)
+    out = fused()
+    fused_grads = backward(model, out)
+
+    assert len(out) == len(expected)
+    for a, b in zip(out, expected):
+        assert torch.allclose(a, b, atol=1e-5)
+    assert len(fused_grads) == len(grads)
+    for a, b in zip(fused_grads, grads):
+        assert torch.allclose(a, b, rtol=1e-4, atol=1e-5)
+
+
+def random_graph(num_nodes=60, num_edges=400):
+    torch.manual_seed(12345)
+    edge_index = torch.randint(num_nodes, (2, num_edges))
+    return torch.randn(num_nodes, 16), edge_index
+
+
+def test_saint_forward_pair():
+    SAGE = load_sage('saint_graph.py')
+    model = SAGE(16, 32, 5, 3, dropout=0.0)
+    x, edge_index = random_graph()
+    node_mask = torch.rand(x.size(0)) < 0.7
+
+    check_parity(
+        model,
+        lambda: model(x, edge_index, node_mask) + model(x, edge_index),
+        lambda: sum(model.forward_pair(x, edge_index, node_mask), ()))
+
+
+def test_cluster_forward_pair():
+    SAGE = load_sage('cluster_graph.py')
+    model = SAGE(16, 32, 5, 3, dropout=0.0)
+    x, edge_index = random_graph()
+    cluster = torch.randint(7, (x.size(0), ))
+    edge_mask = torch.rand(edge_index.size(1)) < 0.6
+
+    check_parity(
+        model,
+        lambda: (model(x, edge_index, cluster, edge_mask=edge_mask)
+                 + model(x, edge_index, cluster)),
+        lambda: sum(model.forward_pair(x, edge_index, cluster, edge_mask),
+                    ()))
+
+
+def test_ns_forward_pair():
+    SAGE = load_sage('ns_grpah.py')
+    model = SAGE(16, 32, 5, 3)
+    model.eval()  # Dropout is built into the forward pass.
+    x, edge_index = random_graph()
+    N = x.size(0)
+    loops = torch.arange(N).repeat(2, 1)
+    graph = CSRGraph.from_edge_index(torch.cat([edge_index, loops], 1), N)
+    rate = torch.full((1, ), 0.5, dtype=torch.double)
+    loader = CSRNeighborSampler(graph, [6, 4, 3], batch_size=10,
+                                drop_rate=rate)
+    _, n_id, adjs, adja = next(iter(loader))
+    x = x[n_id]
+
+    check_parity(
+        model,
+        lambda: model(x, adja) + model(x, adjs),
+        lambda: sum(model.forward_pair(x, adjs, adja), ()))
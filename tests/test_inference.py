@@ -0,0 +1,135 @@
+import torch
+from ogb.nodeproppred import Evaluator
+from torch_geometric.nn import SAGEConv
+
+from csr import CSRGraph
+from features import FeatureStore
+from inference import AccuracySink, InferenceEngine
+
+
+def random_splits(num_nodes):
+    # Disjoint train/valid/test masks that leave some nodes out, like the
+    # OGB splits.
+    split = torch.randint(4, (num_nodes, ))
+    return {key: split == i for i, key in enumerate(['train', 'valid', 'test'])}
+
+
+def ogb_accuracy(evaluator, y, pred, mask):
+    return evaluator.eval({
+        'y_true': y[mask].view(-1, 1),
+        'y_pred': pred[mask].view(-1, 1),
+    })['acc']
+
+
+def feed(sink, index, out, batch_size):
+    # Batches in shuffled order, like the row blocks of the `spmm` backend.
+    perm = index[torch.randperm(index.numel())]
+    for batch in perm.split(batch_size):
+        sink(batch, out[batch])
+
+
+def test_accuracy_sink():
+    torch.manual_seed(12345)
+    N, C = 500, 7
+    evaluator = Evaluator('ogbn-products')
+    y = torch.randint(C, (N, 1))
+    out = torch.randn(N, C)
+    # Makes roughly half of the predictions correct.
+    out[torch.arange(N), y.view(-1)] += torch.rand(N) * 2
+    pred = out.argmax(dim=-1)
+    masks = random_splits(N)
+
+    sink = AccuracySink(y, masks, num_classes=C)
+    feed(sink, torch.arange(N), out, batch_size=64)
+    for key, mask in masks.items():
+        expected = ogb_accuracy(evaluator, y, pred, mask)
+        assert abs(sink.accuracy(key) - expected) < 1e-12
+        assert int(sink.confusion[key].trace()) == sink.correct[key]
+        assert int(sink.confusion[key].sum()) == int(mask.sum())
+
+    # `--eval_splits valid,test`: only the rows of the requested splits are
+    # passed to the sink.
+    subset = {key: masks[key] for key in ['valid', 'test']}
+    sink = AccuracySink(y, subset)
+    targets = (subset['valid'] | subset['test']).nonzero().view(-1)
+    feed(sink, targets, out, batch_size=50)
+    assert set(sink.correct) == {'valid', 'test'}
+    for key, mask in subset.items():
+        expected = ogb_accuracy(evaluator, y, pred, mask)
+        assert abs(sink.accuracy(key) - expected) < 1e-12
+
+
+def random_graph(num_nodes=80, num_edges=300, num_features=8):
+    torch.manual_seed(12345)
+    edge_index = torch.randint(num_nodes, (2, num_edges))
+    loops = torch.arange(num_nodes).repeat(2, 1)
+    edge_index = torch.cat([edge_index, loops], dim=1)
+    graph = CSRGraph.from_edge_index(edge_index, num_nodes)
+    return graph, torch.randn(num_nodes, num_features)
+
+
+def random_convs(num_features, num_layers=3):
+    channels = [num_features] + [16] * (num_layers - 1) + [5]
+    return [SAGEConv(channels[i], channels[i + 1]) for i in range(num_layers)]
+
+
+def test_restricted_inference():
+    graph, x = random_graph()
+    convs = random_convs(x.size(1))
+    engine = InferenceEngine(graph, batch_size=7)
+    full = engine.run(convs, x, 'cpu').clone()
+
+    targets = torch.randperm(graph.num_nodes)[:10]
+    out = engine.run(convs, x, 'cpu', targets=targets)
+    assert torch.allclose(out[targets], full[targets], atol=1e-5)
+
+    mask = torch.zeros(graph.num_nodes, dtype=torch.bool)
+    mask[targets] = True
+    out = engine.run(convs, x, 'cpu', targets=mask)
+    assert torch.allclose(out[targets], full[targets], atol=1e-5)
+
+    # The restricted run has to skip some nodes, or the checks above are
+    # vacuous.
+    fields = engine.receptive_fields(targets, len(convs))
+    assert torch.equal(fields[-1], targets)
+    assert fields[0].numel() < graph.num_nodes
+
+
+def test_spmm_backend():
+    graph, x = random_graph()
+    convs = random_convs(x.size(1))
+    sampler = InferenceEngine(graph, batch_size=7)
+    spmm = InferenceEngine(graph, batch_size=7, backend='spmm', num_threads=2)
+    expected = sampler.run(convs, x, 'cpu').clone()
+
+    # The second pass reuses the blocks of the first one.
+    for _ in range(2):
+        out = spmm.run(convs, x, 'cpu')
+        assert torch.allclose(out, expected, atol=1e-5)
+
+    targets = torch.randperm(graph.num_nodes)[:10]
+    out = spmm.run(convs, x, 'cpu', targets=targets)
+    assert torch.allclose(out[targets], expected[targets], atol=1e-5)
+    assert len(spmm.plans) == 2
+
+    store = FeatureStore(x.half())
+    expected = sampler.run(convs, store, 'cpu').clone()
+    out = spmm.run(convs, store, 'cpu')
+    assert torch.allclose(out, expected, atol=1e-5)
+
+
+def test_progress():
+    graph, x = random_graph()
+    convs = random_convs(x.size(1))
+    targets = torch.randperm(graph.num_nodes)[:10]
+    for backend in ['sampler', 'spmm']:
+        calls = []
+        engine = InferenceEngine(graph, batch_size=7, backend=backend,
+                                 progress=lambda *args: calls.append(args))
+        fields = engine.receptive_fields(targets, len(convs))
+        engine.run(convs, x, 'cpu', targets=targets)
+
+        # Every layer counts up to the size of its receptive field.
+        for i, field in enumerate(fields):
+            done = [d for layer, d, total in calls if layer == i]
+            assert done == sorted(done) and done[-1] == field.numel()
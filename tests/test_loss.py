@@ -0,0 +1,95 @@
+import math
+
+import torch
+import torch.nn.functional as F
+
+from loss import jsd_loss, segment_jsd_loss
+
+
+def dense_jsd_loss(enc1, enc2, pos_mask, neg_mask):
+    # The masked loss `SAGE.jsd_loss` used before it was tiled.
+    logits = enc1 @ enc2.t()
+    Epos = (math.log(2.) - F.softplus(- logits))
+    Eneg = (F.softplus(- logits) + logits - math.log(2.))
+    Epos = (Epos * pos_mask).sum() / pos_mask.sum()
+    Eneg = (Eneg * neg_mask).sum() / neg_mask.sum()
+    return Eneg - Epos
+
+
+def masks(label1, label2):
+    pos_mask = torch.eq(label1.view(-1, 1), label2.view(1, -1)).float()
+    return pos_mask, 1 - pos_mask
+
+
+def check_parity(enc1, enc2, label1, label2, chunk_size):
+    a1 = enc1.clone().requires_grad_()
+    a2 = enc2.clone().requires_grad_()
+    out = jsd_loss(a1, a2, label1, label2, chunk_size=chunk_size)
+    out.backward()
+
+    b1 = enc1.clone().requires_grad_()
+    b2 = enc2.clone().requires_grad_()
+    ref = dense_jsd_loss(b1, b2, *masks(label1, label2))
+    ref.backward()
+
+    assert torch.allclose(out, ref, atol=1e-5)
+    assert torch.allclose(a1.grad, b1.grad, atol=1e-6)
+    assert torch.allclose(a2.grad, b2.grad, atol=1e-6)
+
+
+def test_jsd_loss_same_labels():
+    torch.manual_seed(12345)
+    # 37 rows in tiles of 8 leave an uneven last tile of 5.
+    enc1, enc2 = torch.randn(37, 16), torch.randn(37, 16)
+    label = torch.randint(5, (37, ))
+    check_parity(enc1, enc2, label, label, chunk_size=8)
+    check_parity(enc1, enc2, label, label, chunk_size=512)
+
+
+def test_jsd_loss_different_labels():
+    torch.manual_seed(12345)
+    enc1, enc2 = torch.randn(29, 16), torch.randn(23, 16)
+    label1 = torch.randint(4, (29, ))
+    label2 = torch.randint(4, (23, ))
+    check_parity(enc1, enc2, label1, label2, chunk_size=6)
+
+
+def test_jsd_loss_default_label2():
+    torch.manual_seed(12345)
+    enc1, enc2 = torch.randn(10, 8), torch.randn(10, 8)
+    label = torch.randint(3, (10, 1))
+    assert torch.equal(jsd_loss(enc1, enc2, label, chunk_size=3),
+                       jsd_loss(enc1, enc2, label, label, chunk_size=3))
+
+
+def test_jsd_loss_gradcheck():
+    torch.manual_seed(12345)
+    enc1 = torch.randn(11, 4, dtype=torch.double, requires_grad=True)
+    enc2 = torch.randn(7, 4, dtype=torch.double, requires_grad=True)
+    label1 = torch.randint(3, (11, ))
+    label2 = torch.randint(3, (7, ))
+    assert torch.autograd.gradcheck(
+        lambda x, y: jsd_loss(x, y, label1, label2, chunk_size=4),
+        (enc1, enc2))
+
+
+def test_segment_jsd_loss():
+    torch.manual_seed(12345)
+    # More nodes than clusters, and as many, with node i in cluster[i].
+    for N, G in [(40, 6), (9, 9)]:
+        x, g = torch.randn(N, 16), torch.randn(G, 16)
+        cluster = torch.randint(G, (N, ))
+
+        a1, a2 = x.clone().requires_grad_(), g.clone().requires_grad_()
+        out = segment_jsd_loss(a1, a2, cluster)
+        out.backward()
+
+        # The dense positive mask the loss replaced.
+        pos_mask = torch.eye(G)[cluster]
+        b1, b2 = x.clone().requires_grad_(), g.clone().requires_grad_()
+        ref = dense_jsd_loss(b1, b2, pos_mask, 1 - pos_mask)
+        ref.backward()
+
+        assert torch.allclose(out, ref, atol=1e-5)
+        assert torch.allclose(a1.grad, b1.grad, atol=1e-6)
+        assert torch.allclose(a2.grad, b2.grad, atol=1e-6)
@@ -0,0 +1,101 @@
+import copy
+import random
+
+import torch
+from torch_geometric.data import Data
+from torch_geometric.utils import coalesce, degree
+
+from torch_geometric.loader.neighbor_sampler import EdgeIndex
+
+from utils import cluster_graph_aug, drop_clusters, drop_edge_mask, ns_graph_aug
+
+
+def dense_drop(edge_index, idx_drop, num_nodes):
+    # The dense N x N path that `drop_edge_mask` replaced.
+    adj = torch.zeros((num_nodes, num_nodes))
+    adj[edge_index[0], edge_index[1]] = 1
+    adj[idx_drop, :] = 0
+    adj[:, idx_drop] = 0
+    return adj.nonzero().t()
+
+
+def random_batch(seed, num_nodes=40, num_edges=160, num_clusters=4):
+    # A coalesced graph whose nodes are grouped by cluster, like the
+    # mini-batches of `ClusterLoader`.
+    gen = torch.Generator().manual_seed(seed)
+    edge_index = torch.randint(num_nodes, (2, num_edges), generator=gen)
+    edge_index = coalesce(edge_index, num_nodes=num_nodes)
+    cluster = torch.randint(num_clusters, (num_nodes, ), generator=gen)
+    cluster = cluster.sort()[0]
+    return Data(x=torch.randn(num_nodes, 4, generator=gen),
+                edge_index=edge_index, node_cluster=cluster)
+
+
+def test_drop_edge_mask():
+    for seed in range(10):
+        data = random_batch(seed)
+        N = data.num_nodes
+        idx_drop = torch.randperm(N)[:seed + 1]
+        expected = dense_drop(data.edge_index, idx_drop, N)
+
+        keep = drop_edge_mask(data.edge_index, idx_drop, N)
+        assert torch.equal(data.edge_index[:, keep], expected)
+
+        mask = torch.zeros(N, dtype=torch.bool)
+        mask[idx_drop] = True
+        keep = drop_edge_mask(data.edge_index, mask, N)
+        assert torch.equal(data.edge_index[:, keep], expected)
+
+
+def test_cluster_graph_aug():
+    rate = 0.3
+    for seed in range(10):
+        data = random_batch(seed)
+        N, cluster = data.num_nodes, data.node_cluster
+
+        # The `int(size * rate)` nodes of lowest degree of every cluster,
+        # ties broken by node id.
+        node_degree = degree(data.edge_index[0], N)
+        idx_drop = []
+        for i in range(int(cluster.max()) + 1):
+            nodes = (cluster == i).nonzero().view(-1)
+            order = torch.sort(node_degree[nodes], stable=True)[1]
+            idx_drop.append(nodes[order[:int(nodes.numel() * rate)]])
+        expected = dense_drop(data.edge_index, torch.cat(idx_drop), N)
+
+        view = cluster_graph_aug(data, rate, cluster)
+        assert torch.equal(data.edge_index[:, view.edge_mask], expected)
+
+
+def test_drop_clusters():
+    for seed in range(10):
+        data = random_batch(seed)
+        N = data.num_nodes
+
+        random.seed(seed)
+        drop = random.choice(list(range(1, int(data.node_cluster.max()))))
+        idx_drop = (data.node_cluster == drop).nonzero().view(-1)
+        expected = dense_drop(data.edge_index, idx_drop, N)
+
+        random.seed(seed)
+        out = drop_clusters(copy.copy(data))
+        assert torch.equal(out.edge_index, expected)
+
+
+def test_ns_graph_aug():
+    torch.manual_seed(12345)
+    adjs = []
+    for num in [90, 30, 10]:
+        edge_index = torch.randint(20, (2, num))
+        adjs.append(EdgeIndex(edge_index, torch.randperm(1000)[:num], (20, 8)))
+
+    for rate in [-0.5, 0., 0.3, 1., 1.7]:
+        out = ns_graph_aug(list(adjs), rate)
+        for i, (adj, adja) in enumerate(zip(adjs, out)):
+            num = adj.edge_index.size(1)
+            drop = min(max(int(num * rate / (i + 1)), 0), num)
+            assert adja.e_id.numel() == num - drop
+            # A subset of the hop itself, in its order.
+            keep = (adj.e_id.view(-1, 1) == adja.e_id.view(1, -1)).any(dim=1)
+            assert torch.equal(adj.e_id[keep], adja.e_id)
+            assert torch.equal(adj.edge_index[:, keep], adja.edge_index)
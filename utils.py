@@ -3,6 +3,8 @@ import torch.nn as nn
 import torch.nn.functional as F
 import numpy as np
 import os
+import copy
+import math
 #import pyro
 import random
 from torch_geometric.utils import degree
@@ -11,93 +13,151 @@ from scipy import sparse as sp
 from sklearn.preprocessing import normalize, StandardScaler
 from cytoolz import curry
 from torch_geometric.data import Data, Batch
+from torch_sparse import SparseTensor
+
+
+class AugView(object):
+    r"""Augmented view of a mini-batch that shares every tensor of
+    :obj:`data` and only carries the perturbation, so building it costs
+    O(N + E) booleans instead of a full copy of the batch.
+
+    The masks are applied lazily inside :obj:`SAGE.forward`.
+
+    Args:
+        data (torch_geometric.data.Data): The clean mini-batch.
+        node_mask (torch.Tensor, optional): Boolean mask of the nodes whose
+            features are kept; the others are zeroed. (default: :obj:`None`)
+        edge_mask (torch.Tensor, optional): Boolean mask of the edges of
+            :obj:`data.edge_index` (or of the non-zeros of :obj:`data.adj_t`)
+            that are kept. (default: :obj:`None`)
+        **kwargs (optional): Extra tensors computed alongside the view
+            (e.g. the anchors of :meth:`saint_pair_aug`).
+    """
+    def __init__(self, data, node_mask=None, edge_mask=None, **kwargs):
+        self.data = data
+        self.node_mask = node_mask
+        self.edge_mask = edge_mask
+        self.__dict__.update(kwargs)
+
+    @property
+    def x(self):
+        return self.data.x
+
+    @property
+    def edge_index(self):
+        return self.data.edge_index
+
+    @property
+    def adj_t(self):
+        return self.data.adj_t
+
+    def to(self, device):
+        view = copy.copy(self)
+        view.data = self.data.to(device)
+        for key, item in self.__dict__.items():
+            if isinstance(item, torch.Tensor):
+                setattr(view, key, item.to(device))
+        return view
+
+
+class PairAug(object):
+    r"""Loader transform that appends an augmented view of the last element
+    of a mini-batch, so that :obj:`(clean, augmented)` pairs are built
+    inside the :class:`~torch.utils.data.DataLoader` worker processes.
+
+    Args:
+        fn (callable): The augmentation, called as
+            :obj:`fn(batch[-1], rate, **kwargs)`. It must be picklable.
+        rate (torch.Tensor): One-element tensor in shared memory holding the
+            current perturbation rate, kept up to date by :class:`AutoR`.
+        **kwargs (optional): Additional arguments of :obj:`fn`.
+    """
+    def __init__(self, fn, rate, **kwargs):
+        self.fn = fn
+        self.rate = rate
+        self.kwargs = kwargs
+
+    def __call__(self, *batch):
+        return batch + (self.fn(batch[-1], float(self.rate), **self.kwargs), )
 
 
 def adaptive_aug(data, rate, index, neighbor, cluster):
-    a = np.array([])
-    index = index.detach().cpu().numpy()
-    neighbor = neighbor.detach().cpu().numpy()
-    cluster = cluster.detach().cpu().numpy()
-
-    node_num, feat_dim = data.x.size()
+    node_num, _ = data.x.size()
     mask_num = int(index.shape[0] * rate)
 
-    idx_add = np.random.choice(index, mask_num)
-    for i in range(mask_num):
-        idx = np.argwhere(cluster == idx_add[i])
-        a = np.append(a, idx)
-    a = neighbor[a.astype(int)]
-    a = np.unique(a)
-    data.x[a] = torch.zeros((a.shape[0], feat_dim))
-    return data
-
-
-def cluster_graph_aug(data, rate, cluster):
-    a = np.array([])
-    index = 0
-    node_degree = degree(data.edge_index[0])
-    for i in range(cluster.max()+1):
-        local = cluster[cluster==i].size()[0]
-        drop_num = int(local * rate)
-        _, idx= torch.topk(node_degree[index:index+local], drop_num, largest=False)
-        a= np.append(a, idx+index)
-        index = index+local
+    # Anchors are drawn with replacement; every edge `cluster -> neighbor`
+    # leaving a drawn anchor is found with one lookup instead of a scan of
+    # the edge list per anchor.
+    idx_add = index[torch.randint(index.shape[0], (mask_num,), device=index.device)]
+    anchor = torch.zeros(node_num, dtype=torch.bool, device=cluster.device)
+    anchor[idx_add.to(cluster.device)] = True
+    a = neighbor[anchor[cluster]]
+    node_mask = torch.ones(node_num, dtype=torch.bool, device=data.x.device)
+    node_mask[a.to(data.x.device)] = False
+    return AugView(data, node_mask=node_mask)
+
+
+def cluster_graph_aug(data, rate, cluster=None):
+    if cluster is None:
+        cluster = data.node_cluster
     node_num, _ = data.x.size()
-    _, edge_num = data.edge_index.size()
-    # idx_nondrop = [n for n in range(node_num) if not n in a]
-    # data.x = data.x[idx_nondrop]
+    edge_index = edge_pairs(data)
+    node_degree = degree(edge_index[0], node_num)
+    drop_num = (torch.bincount(cluster).double() * float(rate)).long()
+    a = segment_bottomk(node_degree, cluster, drop_num)
 
-    edge_index = data.edge_index.numpy()
-
-    adj = torch.zeros((node_num, node_num))
-    adj[edge_index[0], edge_index[1]] = 1
-    adj[a, :] = 0
-    adj[:, a] = 0
-    edge_index = adj.nonzero().t()
-
-    data.edge_index = edge_index
-    return data
+    keep = drop_edge_mask(edge_index, a, node_num)
+    return AugView(data, edge_mask=keep)
 
 def saint_graph_aug(data, rate, index, neighbor, cluster):
-    a = np.array([])
-    index = index.detach().cpu().numpy()
-    neighbor = neighbor.detach().cpu().numpy()
-    cluster = cluster.detach().cpu().numpy()
-
-    node_num, feat_dim = data.x.size()
-    mask_num = int(index.shape[0]*rate)
-
-    idx_add = np.random.choice(index, mask_num)
-    for i in range(mask_num):
-        idx = np.argwhere(cluster == idx_add[i])
-        a = np.append(a, idx)
-    a = neighbor[a.astype(int)]
-    a = np.unique(a)
-    data.x[a] = torch.zeros((a.shape[0], feat_dim))
-    return data
-
-
-def ns_graph_aug(edge, device, rate):
-    _, edge_num1 = edge[0].edge_index.shape  # 4
-    _, edge_num2 = edge[1].edge_index.shape  # 8
-    _, edge_num3 = edge[2].edge_index.shape  # 24
-
-    permute_num1 = int(edge_num1 * rate)
-    permute_num2 = int(edge_num2 * rate * 1/2)
-    permute_num3 = int(edge_num3 * rate * 1/3)
-
-    edge_index1 = edge[0].edge_index.cpu().transpose(0, 1).numpy()
-    edge_index2 = edge[1].edge_index.cpu().transpose(0, 1).numpy()
-    edge_index3 = edge[2].edge_index.cpu().transpose(0, 1).numpy()
-
-    edge_index1 = edge_index1[np.random.choice(edge_num1, edge_num1 - permute_num1, replace=False)]
-    edge_index2 = edge_index2[np.random.choice(edge_num2, edge_num2 - permute_num2, replace=False)]
-    edge_index3 = edge_index3[np.random.choice(edge_num3, edge_num3 - permute_num3, replace=False)]
-    edge[0] = edge[0]._replace(edge_index=torch.tensor(edge_index1).transpose_(0, 1)).to(device)
-    edge[1] = edge[1]._replace(edge_index=torch.tensor(edge_index2).transpose_(0, 1)).to(device)
-    edge[2] = edge[2]._replace(edge_index=torch.tensor(edge_index3).transpose_(0, 1)).to(device)
-
-    return edge
+    return adaptive_aug(data, rate, index, neighbor, cluster)
+
+
+def saint_anchors(data, topk):
+    # Edges `cluster -> neighbor` leaving the first `train_mask.sum()` nodes
+    # of a GraphSAINT batch, and the `topk` highest-degree sources among them.
+    # Selected by mask, as the batch edges need not be sorted by source.
+    num_train = int(data.train_mask.sum())
+    edge_index = edge_pairs(data)
+    neighbor_edge = edge_index[:, edge_index[0] < num_train]
+    neighbor = neighbor_edge[1]
+    cluster = neighbor_edge[0]
+    node_degree = degree(cluster, num_train)
+
+    _, index = torch.topk(node_degree, topk)
+    return index, neighbor, cluster
+
+
+def saint_pair_aug(data, rate, topk):
+    index, neighbor, cluster = saint_anchors(data, topk)
+    view = adaptive_aug(data, rate, index, neighbor, cluster)
+    view.index, view.neighbor, view.cluster = index, neighbor, cluster
+    return view
+
+
+def ns_graph_aug(edge, rate):
+    # Hop `i` of the sampled `adjs` (24/8/4 fan-outs) loses
+    # int(E_i * rate * 1/(i+1)) of its edges, clamped to [0, E_i] as AutoR
+    # does not bound the rate. The random keys of all hops are
+    # drawn in one call on the device of the edges; the drop counts depend
+    # only on edge counts, so slicing never waits on the device.
+    device = edge[0].edge_index.device
+    edge_num = [adj.edge_index.size(1) for adj in edge]
+    permute_num = [min(max(int(num * rate * 1 / (i + 1)), 0), num)
+                   for i, num in enumerate(edge_num)]
+
+    hop = torch.cat([torch.full((num,), i, dtype=torch.long, device=device)
+                     for i, num in enumerate(edge_num)])
+    perm = segment_sort(torch.rand(hop.numel(), device=device), hop)
+
+    out, ptr = [], 0
+    for adj, num, drop in zip(edge, edge_num, permute_num):
+        keep = perm[ptr + drop:ptr + num].sort()[0] - ptr
+        e_id = None if adj.e_id is None else adj.e_id[keep]
+        out.append(adj._replace(edge_index=adj.edge_index[:, keep], e_id=e_id))
+        ptr += num
+
+    return out
 
 def drop_nodes(data, rate):
     node_num, _ = data.x.size()
@@ -123,6 +183,12 @@ def drop_nodes(data, rate):
 def permute_edges(data, rate):
 
     node_num, _ = data.x.size()
+    if 'adj_t' in data:
+        edge_num = data.adj_t.nnz()
+        keep = torch.zeros(edge_num, dtype=torch.bool)
+        keep[torch.randperm(edge_num)[:edge_num - int(edge_num * rate)]] = True
+        data.adj_t = mask_edges(data.adj_t, keep)
+        return data
     _, edge_num = data.edge_index.size()
     permute_num = int(edge_num * rate)
     edge_index = data.edge_index.transpose(0, 1).numpy()
@@ -191,6 +257,65 @@ def ns_mask_nodes(data, rate):
     data[idx_mask] = torch.zeros((mask_num, feat_dim))
     return data
 
+class AutoR(object):
+    r"""AutoR controller for the augmentation perturbation rate.
+
+    After every batch the rate moves by :obj:`limt * f(d)`, where :obj:`d`
+    is the drop of the loss since the previous batch: up when the loss went
+    down, down when it went up. Only the previous loss is kept, as a
+    detached Python float, so the state is O(1) however long the epoch is.
+
+    Args:
+        rate (float): The initial perturbation rate.
+        limt (float): AutoR's penalty intensity (:obj:`--limt`).
+        mode (str, optional): :obj:`"sigmoid"` for :obj:`f(d) = sigmoid(d)`
+            (GraphSAINT, Cluster-GCN) or :obj:`"linear"` for :obj:`f(d) = d`
+            (GraphSAGE). (default: :obj:`"sigmoid"`)
+        shared (torch.Tensor, optional): One-element tensor in shared memory
+            that mirrors the current rate for loader workers (see
+            :class:`PairAug`). (default: :obj:`None`)
+    """
+    def __init__(self, rate, limt, mode='sigmoid', shared=None):
+        assert mode in ['sigmoid', 'linear']
+        self.shared = shared
+        self.rate = float(rate)
+        self.limt = limt
+        self.mode = mode
+        self.prev = None
+        self.history = []
+
+    def step(self, loss):
+        loss = float(loss)
+        if self.prev is not None:
+            if loss < self.prev:
+                self.rate = self.rate + self.limt * self.scale(self.prev - loss)
+            elif loss > self.prev:
+                self.rate = self.rate - self.limt * self.scale(loss - self.prev)
+        self.prev = loss
+        return self.rate
+
+    @property
+    def rate(self):
+        return self._rate
+
+    @rate.setter
+    def rate(self, rate):
+        self._rate = rate
+        if self.shared is not None:
+            self.shared.fill_(rate)
+
+    def scale(self, diff):
+        if self.mode == 'sigmoid':
+            return 1. / (1. + math.exp(-diff))
+        return diff
+
+    def end_epoch(self):
+        # Batches are only compared within an epoch.
+        self.prev = None
+        self.history.append(self.rate)
+        return self.rate
+
+
 def set_seeds(seed):
     random.seed(seed)
     np.random.seed(seed)
@@ -203,23 +328,72 @@ def set_seeds(seed):
 def drop_clusters(data):
 
     node_num, _ = data.x.size()
-    _, edge_num = data.edge_index.size()
 
     drop = random.choice([i for i in range(1, data.node_cluster.max())])
     idx_drop = data.node_cluster==drop
-    idx_drop = np.where(idx_drop)[0]
-
-    # idx_nondrop = [n for n in range(node_num) if not n in idx_drop]
-    # idx_dict = {idx_nondrop[n]: n for n in list(range(node_num - drop_num))}
 
-    edge_index = data.edge_index.numpy()
+    keep = drop_edge_mask(data.edge_index, idx_drop, node_num)
+    data.edge_index = data.edge_index[:, keep]
 
-    adj = torch.zeros((node_num, node_num))
-    adj[edge_index[0], edge_index[1]] = 1
-    adj[idx_drop, :] = 0
-    adj[:, idx_drop] = 0
-    edge_index = adj.nonzero().t()
+    return data
 
-    data.edge_index = edge_index
 
-    return data
+def drop_edge_mask(edge_index, idx_drop, num_nodes):
+    # Edges that survive removing the rows and columns of `idx_drop` (node
+    # indices or a boolean node mask) from the adjacency, found in O(E)
+    # without materializing the dense N x N matrix.
+    drop = torch.zeros(num_nodes, dtype=torch.bool, device=edge_index.device)
+    drop[idx_drop.to(edge_index.device)] = True
+    return ~(drop[edge_index[0]] | drop[edge_index[1]])
+
+
+def edge_pairs(data):
+    # The (source, target) pairs of a batch: its `edge_index`, or the
+    # non-zeros of its transposed `adj_t` in CSR order, so that edge masks
+    # apply to either.
+    if 'adj_t' in data:
+        row, col, _ = data.adj_t.coo()
+        return torch.stack([col, row], dim=0)
+    return data.edge_index
+
+
+def mask_edges(edge_index, edge_mask):
+    # Keeps the edges `edge_mask` of an `edge_index` or of an `adj_t`.
+    if isinstance(edge_index, SparseTensor):
+        return edge_index.masked_select_nnz(edge_mask, layout='coo')
+    return edge_index[:, edge_mask]
+
+
+def union_graphs(a, b, num_nodes):
+    # Disjoint union of two graphs over the same `num_nodes` nodes, the
+    # nodes of `b` offset by `num_nodes`. Both are `edge_index` or both are
+    # row-sorted `adj_t`, whose concatenation stays row-sorted.
+    if isinstance(a, SparseTensor):
+        row_a, col_a, _ = a.coo()
+        row_b, col_b, _ = b.coo()
+        return SparseTensor(row=torch.cat([row_a, row_b + num_nodes]),
+                            col=torch.cat([col_a, col_b + num_nodes]),
+                            sparse_sizes=(2 * num_nodes, 2 * num_nodes),
+                            is_sorted=True)
+    return torch.cat([a, b + num_nodes], dim=1)
+
+
+def segment_sort(src, index):
+    # Permutation ordering the entries by segment `index` first and by `src`
+    # within each segment, built from two stable sorts instead of a Python
+    # loop over segments.
+    perm = torch.sort(src, stable=True)[1]
+    perm = perm[torch.sort(index[perm], stable=True)[1]]
+    return perm
+
+
+def segment_bottomk(src, index, k):
+    # Positions of the `k[i]` smallest values of `src` inside every segment
+    # `i` of `index` (e.g. the `node_cluster` vector of a ClusterLoader
+    # batch), selected for all segments in one pass.
+    perm = segment_sort(src, index)
+    count = torch.bincount(index, minlength=k.numel())
+    ptr = count.cumsum(0) - count
+    seg = index[perm]
+    rank = torch.arange(perm.numel(), device=src.device) - ptr[seg]
+    return perm[rank < k.to(src.device)[seg]]